@@ -3,7 +3,7 @@
 # filename: covariance.pyx
 
 import numpy as np
-from scipy.linalg import block_diag
+from scipy.linalg import block_diag, cholesky_banded, cho_solve_banded
 cimport numpy as np
 cimport cython
 import Starfish.constants as C
@@ -63,6 +63,24 @@ def sigma(np.ndarray[np.double_t, ndim=2] gparams, np.ndarray[np.double_t, ndim=
 
     return mat
 
+def k_matrix(np.ndarray[np.double_t, ndim=2] params0, np.ndarray[np.double_t, ndim=2] params1, np.ndarray[np.double_t, ndim=1] h2param):
+    '''
+    Vectorized version of the emulator covariance function `k`, evaluated
+    between every pair of parameters in two sets.
+
+    :param params0: first set of input parameters
+    :type params0: 2D np.array (n0, nparam)
+    :param params1: second set of input parameters
+    :type params1: 2D np.array (n1, nparam)
+    :param h2param: the set of Gaussian Process hyperparameters, already
+      squared. [amplitude, l0, l1, l2, ..., l(len(parname) - 1)].
+    :type h2param: np.array
+
+    :returns: (2D np.array) covariance matrix of shape (n0, n1)
+    '''
+    dp = (params0[:, np.newaxis, :] - params1[np.newaxis, :, :])**2
+    return h2param[0] * np.exp(-0.5 * np.sum(dp/h2param[1:], axis=2))
+
 def Sigma(np.ndarray[np.double_t, ndim=2] gparams, np.ndarray[np.double_t, ndim=2] h2params):
     '''
     Fill in the large Sigma matrix using blocks of smaller sigma matrices.
@@ -192,6 +210,284 @@ def get_dense_C(np.ndarray[np.double_t, ndim=1] wl, k_func, double max_r):
 
     return mat
 
+def default_max_r(logAmp=None, l=None, regions=None):
+    '''
+    The largest taper radius (km/s) of the kernels, beyond which they are zero.
+    '''
+    max_r = 0.0
+    if logAmp is not None:
+        max_r = 6.0 * l
+    if regions is not None:
+        max_r = max(max_r, 4.0 * np.max(regions[:, 2]))
+    return max_r
+
+class PixelDistances:
+    '''
+    The pairwise velocity separations between the pixels of a wavelength vector,
+    for all pairs closer than a maximum radius. They only depend on the
+    wavelengths, so they can be computed once (e.g., per echelle order) and
+    reused every time the covariance matrix is rebuilt for new hyperparameters.
+
+    The pairs (i, j), i >= j, are stored in compact arrays sorted by
+    separation, so that the pairs within any radius smaller than ``max_r``
+    are a leading slice.
+
+    :param wl: numpy wavelength vector, sorted in increasing order
+    :param max_r: (km/s) max velocity separation to store
+    '''
+
+    def __init__(self, np.ndarray[np.double_t, ndim=1] wl, double max_r):
+        cdef int N = len(wl)
+        cdef int d = 0
+
+        self.wl = wl
+        self.N = N
+        self.max_r = max_r
+
+        ii, jj, rrs = [], [], []
+        for d in range(N):
+            # Pairs of pixels (i, j) = (j + d, j), i >= j
+            rr = np.abs(wl[d:] - wl[:N - d]) * C.c_kms/wl[:N - d] #Velocity space
+            j = np.nonzero(rr < max_r)[0]
+            if len(j) == 0:
+                break
+            ii.append(j + d)
+            jj.append(j)
+            rrs.append(rr[j])
+
+        i = np.concatenate(ii)
+        j = np.concatenate(jj)
+        rr = np.concatenate(rrs)
+
+        order = np.argsort(rr, kind="mergesort")
+        self.i = i[order].astype(np.int32)
+        self.j = j[order].astype(np.int32)
+        # The separation used to select pairs, and the one used by the kernels
+        self.rr = rr[order]
+        self.r = C.c_kms/wl[self.i] * np.abs(wl[self.i] - wl[self.j])
+
+    def get_C(self, logAmp=None, l=None, regions=None, max_r=None, banded=False):
+        '''
+        Fill out the covariance matrix from the stored separations, with the same
+        arguments as :func:`get_C`. If ``max_r`` is larger than the stored
+        radius, the separations are first recomputed out to a larger radius.
+        '''
+
+        if max_r is None:
+            max_r = default_max_r(logAmp, l, regions)
+
+        if max_r > self.max_r:
+            self.__init__(self.wl, 1.5 * max_r)
+
+        # All of the pairs that are less than the radius
+        n = np.searchsorted(self.rr, max_r, side="left")
+        i = self.i[:n]
+        j = self.j[:n]
+
+        cov = np.zeros((n,))
+
+        #Initialize the global covariance
+        if logAmp is not None:
+            amp = 10**logAmp
+            r0 = 6.0 * l
+            r = self.r[:n]
+            ind = (r < r0)
+            r = r[ind]
+            taper = (0.5 + 0.5 * np.cos(np.pi * r/r0))
+            cov[ind] = taper * amp*amp * (1 + np.sqrt(3) * r/l) * np.exp(-np.sqrt(3.) * r/l)
+
+        #If covered by a region, instantiate
+        if regions is not None:
+            wl0 = self.wl[i]
+            wl1 = self.wl[j]
+            for row in regions:
+                a = 10**row[0]
+                mu = row[1]
+                sigma = row[2]
+
+                rx0 = C.c_kms / mu * np.abs(wl0 - mu)
+                rx1 = C.c_kms / mu * np.abs(wl1 - mu)
+                r_tap = np.maximum(rx0, rx1) # choose the larger distance
+                r0_r = 4.0 * sigma # where the kernel goes to 0
+
+                ind = (r_tap < r0_r)
+                taper = (0.5 + 0.5 * np.cos(np.pi * r_tap[ind]/r0_r))
+                cov[ind] += taper * a*a * np.exp(-0.5 * (C.c_kms * C.c_kms) / (mu * mu) * ((wl0[ind] - mu)**2 + (wl1[ind] - mu)**2)/(sigma * sigma))
+
+        if banded:
+            d = i - j
+            nbands = np.max(d) + 1 if n > 0 else 0
+            ab = np.zeros((nbands, self.N))
+            ab[d, j] = cov
+            return ab
+
+        #The matrix that we want to fill
+        mat = np.zeros((self.N, self.N))
+        mat[i, j] = cov
+        mat[j, i] = cov
+        return mat
+
+def get_C(np.ndarray[np.double_t, ndim=1] wl, logAmp=None, l=None, regions=None, max_r=None, banded=False):
+    '''
+    Fill out the covariance matrix directly from the wavelength vector and the
+    hyperparameters, using the same kernels as :func:`make_k_func` and
+    :func:`make_k_func_region`. The kernels are evaluated with vectorized
+    operations, and only for the pairs of pixels closer than ``max_r``.
+
+    To rebuild the matrix many times for the same wavelengths, create a
+    :obj:`PixelDistances` once and use its ``get_C`` method instead.
+
+    :param wl: numpy wavelength vector, sorted in increasing order
+    :param logAmp: log10 amplitude of the global (tapered Matern 3/2) kernel. If
+      None, the global kernel is left out.
+    :param l: (km/s) length scale of the global kernel
+    :param regions: None, or 2D array with rows of [logAmp, mu, sigma] for the
+      Gaussian region kernels.
+    :param max_r: (km/s) max velocity to fill out to. Defaults to the largest
+      taper radius of the kernels, beyond which they are zero.
+    :param banded: if True, return the lower triangle in the banded storage used by
+      :func:`scipy.linalg.cholesky_banded`, ``ab[i - j, j] = C[i, j]``, with as
+      many rows as there are diagonals with pixels closer than ``max_r``.
+      Otherwise return the dense matrix.
+
+    :returns: (2D np.array) covariance matrix, either (N, N) or (nbands, N)
+    '''
+
+    if max_r is None:
+        max_r = default_max_r(logAmp, l, regions)
+
+    return PixelDistances(wl, max_r).get_C(logAmp, l, regions, max_r, banded)
+
+def banded_to_dense(np.ndarray[np.double_t, ndim=2] ab):
+    '''
+    Convert a symmetric matrix from lower banded storage, ``ab[i - j, j] = C[i, j]``,
+    to a dense matrix.
+
+    :param ab: banded matrix
+    :type ab: 2D np.array (nbands, N)
+
+    :returns: (2D np.array) dense (N, N) matrix
+    '''
+    cdef int N = ab.shape[1]
+
+    #The matrix that we want to fill
+    mat = np.zeros((N,N))
+    for d in range(len(ab)):
+        j = np.arange(N - d)
+        mat[j + d, j] = ab[d, :N - d]
+        mat[j, j + d] = ab[d, :N - d]
+
+    return mat
+
+def banded_sum(*mats):
+    '''
+    Add together several symmetric matrices in lower banded storage, which may
+    have different numbers of bands.
+
+    :returns: (2D np.array) banded matrix with as many bands as the widest input
+    '''
+    nbands = max(len(mat) for mat in mats)
+    out = np.zeros((nbands, mats[0].shape[1]))
+    for mat in mats:
+        out[:len(mat)] += mat
+    return out
+
+def factor_banded(np.ndarray[np.double_t, ndim=2] ab):
+    '''
+    Cholesky factor a symmetric positive definite matrix in lower banded storage.
+    A banded factorization costs O(N p^2) for p bands. If there is only one band
+    (white noise), the factor is the diagonal itself.
+
+    :param ab: banded matrix
+    :type ab: 2D np.array (nbands, N)
+
+    :returns: (factor, logdet)
+    :raises np.linalg.LinAlgError: if the matrix is not positive definite
+    '''
+    if len(ab) == 1:
+        if np.any(ab[0] <= 0.0):
+            raise np.linalg.LinAlgError("Data covariance matrix is not positive definite.")
+        return (ab[0], np.sum(np.log(ab[0])))
+
+    factor = cholesky_banded(ab, lower=True)
+    return (factor, np.sum(2 * np.log(factor[0])))
+
+def solve_banded(factor, B, out=None):
+    '''
+    Solve D x = B using the factor of D returned by :func:`factor_banded`.
+
+    :param B: right hand side
+    :type B: 1D or 2D np.array
+    :param out: optional array to store the solution in, which for a 2D ``B``
+      must be in Fortran order for LAPACK to solve in place
+    :type out: np.array
+    '''
+    if factor.ndim == 1:
+        # White noise. Divide one column at a time, because numpy allocates a
+        # buffer to broadcast the factor across the columns.
+        if B.ndim == 1:
+            return np.divide(B, factor, out=out)
+        if out is None:
+            out = np.empty_like(B)
+        for i in range(B.shape[1]):
+            np.divide(B[:, i], factor, out=out[:, i])
+        return out
+    if out is None:
+        return cho_solve_banded((factor, True), B)
+    out[:] = B
+    return cho_solve_banded((factor, True), out, overwrite_b=True, check_finite=False)
+
+def woodbury_lnlike(factor, double logdet_D, X, R, C_X, iDX=None, iDR=None):
+    '''
+    Evaluate the Gaussian log likelihood of the residuals R with covariance
+    D + X C_X X^T, given the factor of D from :func:`factor_banded`. The (N, N)
+    covariance is never formed. Instead,
+
+    (D + X C X^T)^-1 = D^-1 - D^-1 X (I + C S)^-1 C X^T D^-1
+    |D + X C X^T| = |D| |I + C S|
+
+    with S = X^T D^-1 X, which only needs solves against D and an (m, m) solve.
+
+    :param factor: factor of D
+    :param logdet_D: log determinant of D
+    :param X: design matrix
+    :type X: 2D np.array (N, m)
+    :param R: residuals
+    :type R: 1D np.array (N,)
+    :param C_X: prior covariance of the weights of the columns of X
+    :type C_X: 2D np.array (m, m)
+    :param iDX: optional workspace for D^-1 X, in Fortran order
+    :param iDR: optional workspace for D^-1 R
+
+    :returns: (float) lnlike
+    :raises np.linalg.LinAlgError: if I + C S is not positive definite
+    '''
+    iDX = solve_banded(factor, X, out=iDX)
+    iDR = solve_banded(factor, R, out=iDR)
+    S = X.T.dot(iDX)
+    b = X.T.dot(iDR)
+
+    A = np.eye(len(S)) + C_X.dot(S)
+    sign, logdet_A = np.linalg.slogdet(A)
+    if sign <= 0:
+        raise np.linalg.LinAlgError("Emulator covariance term is not positive definite.")
+
+    chi2 = np.dot(R, iDR) - np.dot(b, np.linalg.solve(A, C_X.dot(b)))
+    return -0.5 * (chi2 + logdet_D + logdet_A)
+
+def woodbury_solve(factor, X, C_X, B):
+    '''
+    Solve (D + X C_X X^T) x = B, with the same Woodbury identity as
+    :func:`woodbury_lnlike`.
+
+    :param B: right hand side
+    :type B: 1D or 2D np.array
+    '''
+    iDX = solve_banded(factor, X)
+    iDB = solve_banded(factor, B)
+    A = np.eye(len(C_X)) + C_X.dot(X.T.dot(iDX))
+    return iDB - iDX.dot(np.linalg.solve(A, C_X.dot(X.T.dot(iDB))))
+
 def make_k_func(par):
     cdef double amp = 10**par.logAmp
     cdef double l = par.l #Given in Km/s
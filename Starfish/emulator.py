@@ -1,12 +1,14 @@
 import numpy as np
 import h5py
 from sklearn.decomposition import PCA
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
 import math
 import os
+import copy
 
 import Starfish
 from Starfish.grid_tools import HDF5Interface, determine_chunk_log
-from Starfish.covariance import Sigma, sigma, V12, V22, V12m, V22m
+from Starfish.covariance import Sigma, sigma, k_matrix
 from Starfish import constants as C
 
 def Phi(eigenspectra, M):
@@ -28,39 +30,115 @@ def get_w_hat(eigenspectra, fluxes, M):
     Since we will overflow memory if we actually calculate Phi, we have to
     determine w_hat in a memory-efficient manner.
 
+    Phi^T fluxes is a single (m, M) matrix product, and Phi^T Phi is inverted
+    in closed form through its Kronecker structure.
     '''
-    m = len(eigenspectra)
-    out = np.empty((M * m,))
-    for i in range(m):
-        for j in range(M):
-            out[i * M + j] = eigenspectra[i].T.dot(fluxes[j])
+    out = np.dot(eigenspectra, fluxes.T).flatten()
 
-
-    PhiPhi = np.linalg.inv(skinny_kron(eigenspectra, M))
-
-    return PhiPhi.dot(out)
+    return KronIdentity.from_eigenspectra(eigenspectra, M).solve(out)
 
 def skinny_kron(eigenspectra, M):
     '''
     Compute Phi.T.dot(Phi) in a memory efficient manner.
 
     eigenspectra is a list of 1D numpy arrays.
+
+    This materializes the full (m * M, m * M) matrix. Use
+    :obj:`KronIdentity` to work with it without doing so.
+    '''
+    return KronIdentity.from_eigenspectra(eigenspectra, M).todense()
+
+class KronIdentity:
+    '''
+    A matrix with the structure A (x) I_M, for example Phi^T Phi = (E E^T) (x) I_M,
+    where E are the eigenspectra. Only the small (m, m) matrix A is stored, and
+    the full (m * M, m * M) matrix is applied, solved and inverted in closed form.
+
+    Vectors are ordered with the eigenspectrum index varying slowest, so that
+    element i * M + j corresponds to eigenspectrum i and grid point j.
+
+    :param A: the (m, m) matrix
+    :type A: 2D np.array
+    :param M: number of spectra in the synthetic library
+    :type M: int
     '''
-    m = len(eigenspectra)
-    out = np.zeros((m * M, m * M))
-
-    # Compute all of the dot products pairwise, beforehand
-    dots = np.empty((m, m))
-    for i in range(m):
-        for j in range(m):
-            dots[i,j] = eigenspectra[i].T.dot(eigenspectra[j])
-
-    for i in range(M * m):
-        for jj in range(m):
-            ii = i // M
-            j = jj * M + (i % M)
-            out[i, j] = dots[ii, jj]
-    return out
+
+    def __init__(self, A, M):
+        self.A = A
+        self.m = len(A)
+        self.M = M
+        self.shape = (self.m * self.M, self.m * self.M)
+
+    @classmethod
+    def from_eigenspectra(cls, eigenspectra, M):
+        '''
+        Create Phi^T Phi from the eigenspectra.
+
+        :param eigenspectra: the principal component eigenspectra
+        :type eigenspectra: 2D np.array
+        :param M: number of spectra in the synthetic library
+        :type M: int
+        '''
+        return cls(np.dot(eigenspectra, np.transpose(eigenspectra)), M)
+
+    def is_block_diagonal(self, rtol=1e-8):
+        '''
+        True if A is diagonal, i.e. the matrix is block-diagonal in the
+        eigenspectra with blocks proportional to I_M. The off-diagonal elements
+        are compared to the largest diagonal element, so that the test does not
+        depend on the overall scale of A (such as 1/lambda_xi).
+
+        :param rtol: largest relative size of an off-diagonal element
+        :type rtol: float
+        '''
+        diag = np.diag(self.A)
+        offdiag = self.A - np.diag(diag)
+        return np.abs(offdiag).max() <= rtol * np.abs(diag).max()
+
+    @property
+    def block_diagonal(self):
+        '''
+        True if A is diagonal, to within :meth:`is_block_diagonal`'s default tolerance.
+        '''
+        return self.is_block_diagonal()
+
+    def _blocks(self, x):
+        # Fold a (m * M,) or (m * M, k) array into (m, M * k) so that A
+        # acts on the eigenspectrum index
+        return np.reshape(x, (self.m, -1))
+
+    def dot(self, x):
+        '''
+        Compute (A (x) I_M) x.
+
+        :param x: (m * M,) or (m * M, k) array
+        '''
+        return np.dot(self.A, self._blocks(x)).reshape(np.shape(x))
+
+    def solve(self, x):
+        '''
+        Compute (A (x) I_M)^-1 x.
+
+        :param x: (m * M,) or (m * M, k) array
+        '''
+        return np.linalg.solve(self.A, self._blocks(x)).reshape(np.shape(x))
+
+    def inv(self):
+        '''
+        Return the inverse, (A^-1) (x) I_M.
+        '''
+        return KronIdentity(np.linalg.inv(self.A), self.M)
+
+    def todense(self):
+        '''
+        Return the full (m * M, m * M) matrix.
+        '''
+        return np.kron(self.A, np.eye(self.M))
+
+    def __mul__(self, scalar):
+        return KronIdentity(scalar * self.A, self.M)
+
+    __rmul__ = __mul__
 
 def Gprior(x, s, r):
     return r**s * x**(s - 1) * np.exp(- x * r) / math.gamma(s)
@@ -277,6 +355,11 @@ class PCAGrid:
             "full wl range ({:.2f}, {:.2f}).".format(min(self.wl[ind]),\
             max(self.wl[ind]), wl_min, wl_max)
 
+        # The chunk is contiguous, so slice rather than index with the boolean
+        # array. The truncated arrays are then views of the full arrays.
+        ind = np.flatnonzero(ind)
+        ind = slice(ind[0], ind[-1] + 1)
+
         self.wl = self.wl[ind]
         self.npix = len(self.wl)
         self.eigenspectra = self.eigenspectra[:, ind]
@@ -328,7 +411,7 @@ class PCAGrid:
 
 
 class Emulator:
-    def __init__(self, pca, eparams):
+    def __init__(self, pca, eparams, block_diagonal=None):
         '''
         Provide the emulation products.
 
@@ -336,6 +419,13 @@ class Emulator:
         :type pca: PCAGrid
         :param eparams: Optimized GP hyperparameters.
         :type eparams: 1D np.array
+        :param block_diagonal: store and factor V11 as m independent (M, M)
+            blocks, one per eigenspectrum, rather than as one dense (m*M, m*M)
+            matrix. If None, use the blocks whenever the eigenspectra are
+            orthogonal (always true for a PCA decomposition). If True for
+            non-orthogonal eigenspectra, the cross terms of Phi^T Phi are
+            neglected.
+        :type block_diagonal: bool
         '''
 
         self.pca = pca
@@ -350,14 +440,35 @@ class Emulator:
         self.dv = self.pca.dv
         self.wl = self.pca.wl
 
-        self.iPhiPhi = (1./self.lambda_xi) * np.linalg.inv(skinny_kron(self.pca.eigenspectra, self.pca.M))
-
-        self.V11 = self.iPhiPhi + Sigma(self.pca.gparams, self.h2params)
+        # Phi^T Phi is block-diagonal in the eigenspectra (and Sigma always is)
+        # if the eigenspectra are orthogonal.
+        self.iPhiPhi = (1./self.lambda_xi) * KronIdentity.from_eigenspectra(self.pca.eigenspectra, self.pca.M).inv()
+        if block_diagonal is None:
+            block_diagonal = self.iPhiPhi.block_diagonal
+        self.block_diagonal = block_diagonal
+
+        # V11 never changes after this point, so factor it once and keep
+        # V11^-1 w_hat around. Each query then only needs triangular solves
+        # against the new V12.
+        if self.block_diagonal:
+            M = self.pca.M
+            self.V11_factors = []
+            self.V11_w_hat = np.empty((self.pca.m * M,))
+            for i, h2param in enumerate(self.h2params):
+                V11 = sigma(self.pca.gparams, h2param)
+                V11[np.diag_indices(M)] += self.iPhiPhi.A[i,i]
+                factor = cho_factor(V11, lower=True)
+                self.V11_factors.append(factor)
+                self.V11_w_hat[i * M:(i + 1) * M] = cho_solve(factor, self.pca.w_hat[i * M:(i + 1) * M])
+
+        else:
+            self.V11 = self.iPhiPhi.todense() + Sigma(self.pca.gparams, self.h2params)
+
+            self.V11_factor = cho_factor(self.V11, lower=True)
+            self.V11_w_hat = cho_solve(self.V11_factor, self.pca.w_hat)
 
         self._params = None # Where we want to interpolate
 
-        self.V12 = None
-        self.V22 = None
         self.mu = None
         self.sig = None
 
@@ -375,6 +486,18 @@ class Emulator:
         hdf5.close()
         return cls(pcagrid, eparams)
 
+    def copy(self):
+        '''
+        Return a shallow copy of the emulator, which shares the PCA arrays and
+        the factored V11 with this one, but which can be truncated with
+        :meth:`determine_chunk_log` and queried independently. This way the
+        emulator only needs to be built once and can be shared by many orders
+        (or forked processes).
+        '''
+        emulator = copy.copy(self)
+        emulator.pca = copy.copy(self.pca)
+        return emulator
+
     def determine_chunk_log(self, wl_data):
         '''
         Possibly truncate the wl grid in response to some data. Also truncate eigenspectra, and flux_mean and flux_std.
@@ -389,42 +512,95 @@ class Emulator:
     @params.setter
     def params(self, pars):
 
-        # If the pars is outside of the range of emulator values, raise a ModelError
-        if np.any(pars < self.min_params) or np.any(pars > self.max_params):
-            raise C.ModelError("Querying emulator outside of original PCA parameter range.")
-
         # Assumes pars is a single parameter combination, as a 1D np.array
-        self._params = pars
-
-        # Do this according to R&W eqn 2.18, 2.19
-
-        # Recalculate V12, V21, and V22.
-        self.V12 = V12(self._params, self.pca.gparams, self.h2params, self.pca.m)
-        self.V22 = V22(self._params, self.h2params, self.pca.m)
+        # If the pars is outside of the range of emulator values, predict
+        # raises a ModelError
+        mu, sig = self.predict(pars[np.newaxis, :])
 
-        # Recalculate the covariance
-        self.mu = self.V12.T.dot(np.linalg.solve(self.V11, self.pca.w_hat))
-        self.mu.shape = (-1)
-        self.sig = self.V22 - self.V12.T.dot(np.linalg.solve(self.V11, self.V12))
+        self._params = pars
+        self.mu = mu[0]
+        self.sig = sig[0]
 
     @property
     def matrix(self):
         return (self.mu, self.sig)
 
+    def predict(self, params, full_cov=False):
+        '''
+        Predict the distribution of the weights at many parameter values at once,
+        according to R&W eqn 2.18, 2.19.
+
+        :param params: parameter values at which to predict the weights
+        :type params: 2D np.array (n, nparam)
+        :param full_cov: if True, return the joint covariance of the weights at
+          all of the parameter values, rather than only at each one separately.
+        :type full_cov: bool
+
+        :returns: (mu, sig). mu is the (n, m) array of mean weights. If
+          ``full_cov`` is False, sig is the (n, m, m) array of covariances of the
+          weights at each parameter value. Otherwise, sig is the (n * m, n * m)
+          joint covariance of ``mu.flatten()``.
+        :raises C.ModelError: if any of the params lie outside of the grid.
+        '''
+
+        params = np.atleast_2d(params)
+        if np.any(params < self.min_params) or np.any(params > self.max_params):
+            raise C.ModelError("Querying emulator outside of original PCA parameter range.")
+
+        n = len(params)
+        m = self.pca.m
+        M = self.pca.M
+
+        # V12, stored as one (M, n) block per eigenspectrum, since the weights of
+        # different eigenspectra are uncorrelated.
+        K = np.array([k_matrix(self.pca.gparams, params, h2param) for h2param in self.h2params])
+
+        mu = np.einsum("ijk,ij->ki", K, self.V11_w_hat.reshape(m, M))
+
+        if self.block_diagonal:
+            # Whiten each block of V12 with its own block of V11
+            W = [solve_triangular(factor[0], K[i], lower=True, check_finite=False) for i, factor in enumerate(self.V11_factors)]
+
+            if full_cov:
+                sig = np.zeros((n * m, n * m))
+                for i, h2param in enumerate(self.h2params):
+                    sig[i::m, i::m] = k_matrix(params, params, h2param) - W[i].T.dot(W[i])
+            else:
+                sig = np.zeros((n, m, m))
+                for i, h2param in enumerate(self.h2params):
+                    sig[:, i, i] = h2param[0] - np.sum(W[i]**2, axis=0)
+
+            return (mu, sig)
+
+        # Assemble the dense V12, with rows ordered like w_hat and columns ordered
+        # like mu.flatten()
+        v12 = np.zeros((m * M, n, m))
+        for i in range(m):
+            v12[i * M:(i + 1) * M, :, i] = K[i]
+
+        W = solve_triangular(self.V11_factor[0], v12.reshape(m * M, n * m), lower=True, check_finite=False)
+
+        if full_cov:
+            sig = -W.T.dot(W)
+            for i, h2param in enumerate(self.h2params):
+                sig[i::m, i::m] += k_matrix(params, params, h2param)
+        else:
+            W.shape = (m * M, n, m)
+            sig = -np.einsum("kpi,kpj->pij", W, W)
+            for i, h2param in enumerate(self.h2params):
+                sig[:, i, i] += h2param[0]
+
+        return (mu, sig)
+
     def draw_many_weights(self, params):
         '''
         :param params: multiple parameters to produce weight draws at.
         :type params: 2D np.array
         '''
 
-        # Local variables, different from instance attributes
-        v12 = V12m(params, self.pca.gparams, self.h2params, self.pca.m)
-        v22 = V22m(params, self.h2params, self.pca.m)
-
-        mu = v12.T.dot(np.linalg.solve(self.V11, self.pca.w_hat))
-        sig = v22 - v12.T.dot(np.linalg.solve(self.V11, v12))
+        mu, sig = self.predict(params, full_cov=True)
 
-        weights = np.random.multivariate_normal(mu, sig)
+        weights = np.random.multivariate_normal(mu.flatten(), sig)
 
         # Reshape these weights into a 2D matrix
         weights.shape = (len(params), self.pca.m)
@@ -437,7 +613,7 @@ class Emulator:
         Using the current settings, draw a sample of PCA weights
         '''
 
-        if self.V12 is None:
+        if self.mu is None:
             print("No parameters are set, yet. Must set parameters first.")
             return
 
@@ -3,7 +3,6 @@ from numpy.fft import fft, ifft, fftfreq, rfftfreq
 from astropy.io import ascii,fits
 from scipy.interpolate import InterpolatedUnivariateSpline, interp1d
 from scipy.integrate import trapz
-from scipy.special import j1
 import multiprocessing as mp
 
 import sys
@@ -16,7 +15,7 @@ import itertools
 from collections import OrderedDict
 
 import Starfish
-from .spectrum import create_log_lam_grid, calculate_dv, calculate_dv_dict
+from .spectrum import create_log_lam_grid, calculate_dv, calculate_dv_dict, BroadeningKernel
 from . import constants as C
 
 def chunk_list(mylist, n=mp.cpu_count()):
@@ -580,6 +579,9 @@ class HDF5Creator:
 
         self.ss[0] = 0.01 # junk so we don't get a divide by zero error
 
+        # Cache of the vsini broadening kernels on ss
+        self.broadening = BroadeningKernel(self.ss)
+
         # The final wavelength grid, onto which we will interpolate the
         # Fourier filtered wavelengths, is part of the Instrument object
         dv_temp = self.Instrument.FWHM/self.Instrument.oversampling
@@ -636,10 +638,7 @@ class HDF5Creator:
 
             if vsini > 0.0:
                 # Calculate the stellar broadening kernel
-                ub = 2. * np.pi * vsini * self.ss
-                sb = j1(ub) / ub - 3 * np.cos(ub) / (2 * ub ** 2) + 3. * np.sin(ub) / (2 * ub ** 3)
-                # set zeroth frequency to 1 separately (DC term)
-                sb[0] = 1.
+                sb = self.broadening(vsini)
 
                 # institute vsini and instrumental taper
                 FF_tap = FF * sb * self.taper
@@ -21,29 +21,24 @@ parser.add_argument("--incremental_save", type=int, default=0, help="How often t
 parser.add_argument("--use_cov", action="store_true", help="Use the local optimal jump matrix if present.")
 args = parser.parse_args()
 
-from multiprocessing import Process, Pipe
 import os
+import sys
 import numpy as np
 
 import Starfish
 import Starfish.grid_tools
 from Starfish.samplers import StateSampler
-from Starfish.spectrum import DataSpectrum, Mask, ChebyshevSpectrum
+from Starfish.spectrum import DataSpectrum, Mask, ChebyshevSpectrum, Resampler, BroadeningKernel
 from Starfish.emulator import Emulator
 import Starfish.constants as C
-from Starfish.covariance import get_dense_C, make_k_func, make_k_func_region
+from Starfish.covariance import PixelDistances, banded_to_dense, banded_sum, factor_banded, woodbury_lnlike, woodbury_solve
 from Starfish.model import ThetaParam, PhiParam
+from Starfish.transport import SharedConnection, MPIConnection, MPIProcess, fork_context
 
-from scipy.special import j1
-from scipy.interpolate import InterpolatedUnivariateSpline
-from scipy.linalg import cho_factor, cho_solve
-from numpy.linalg import slogdet
 from astropy.stats import sigma_clip
 
-import gc
 import logging
 
-from itertools import chain
 from collections import deque
 from operator import itemgetter
 import yaml
@@ -91,10 +86,23 @@ def init_directories(run_index=None):
 
     return routdir
 
-if args.run_index:
-    Starfish.routdir = init_directories(args.run_index)
+# With the MPI transport, every rank imports this module, but only the master
+# (rank 0) sets up the run directory and the log file.
+use_mpi = Starfish.config.get("transport", "pipe") == "mpi"
+if use_mpi:
+    from mpi4py import MPI
+    rank = MPI.COMM_WORLD.rank
 else:
-    Starfish.routdir = ""
+    rank = 0
+
+if rank == 0:
+    if args.run_index:
+        Starfish.routdir = init_directories(args.run_index)
+    else:
+        Starfish.routdir = ""
+
+if use_mpi:
+    Starfish.routdir = MPI.COMM_WORLD.bcast(Starfish.routdir if rank == 0 else None, root=0)
 
 # list of keys from 0 to (norders - 1)
 order_keys = np.arange(len(Starfish.data["orders"]))
@@ -112,8 +120,15 @@ if masks is not None:
         dataSpec.add_mask(myMask.masks)
 
 # Set up the logger
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -  %(message)s", filename="{}log.log".format(
-    Starfish.routdir), level=logging.DEBUG, filemode="w", datefmt='%m/%d/%Y %I:%M:%S %p')
+if rank == 0:
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -  %(message)s", filename="{}log.log".format(
+        Starfish.routdir), level=logging.DEBUG, filemode="w", datefmt='%m/%d/%Y %I:%M:%S %p')
+else:
+    # The other MPI ranks only report warnings and errors, on stderr
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.WARNING)
+    logging.basicConfig(format="%(asctime)s - rank {} - %(levelname)s - %(name)s -  %(message)s".format(rank),
+        handlers=[handler], level=logging.DEBUG, datefmt='%m/%d/%Y %I:%M:%S %p')
 #
 # def perturb(startingDict, jumpDict, factor=3.):
 #     '''
@@ -134,6 +149,20 @@ if Starfish.config.get("use_cov", None):
     # Use an emprically determined covariance matrix to for the jumps.
     pass
 
+# The emulator is only built once per process, and then shared (copy-on-write)
+# with all of the forked subprocesses.
+emulator = None
+
+def get_emulator():
+    '''
+    Return a copy of the shared emulator, for one order to truncate to its own
+    wavelength range. The emulator is read from disk on the first call.
+    '''
+    global emulator
+    if emulator is None:
+        emulator = Emulator.open()
+    return emulator.copy()
+
 def info(title):
     '''
     Print process information useful for debugging.
@@ -158,6 +187,10 @@ class Order:
         self.lnprob = -np.inf
         self.lnprob_last = -np.inf
 
+        # Whether to marginalize the flux scale and the Chebyshev polynomial
+        # in evaluate, if requested in config.yaml
+        self.allow_marginalize = True
+
         self.func_dict = {"INIT": self.initialize,
                           "DECIDE": self.decide_Theta,
                           "INST": self.instantiate,
@@ -188,11 +221,13 @@ class Order:
 
         self.instrument = Instruments[self.spectrum_id]
         self.dataSpectrum = DataSpectra[self.spectrum_id]
-        self.wl = self.dataSpectrum.wls[self.order_key]
-        self.fl = self.dataSpectrum.fls[self.order_key]
-        self.sigma = self.dataSpectrum.sigmas[self.order_key]
+        self.mask = np.asarray(self.dataSpectrum.masks[self.order_key], dtype=bool)
+        # Only keep the unmasked pixels, so that the masked pixels are excluded
+        # both from the likelihood and from the cost of evaluating it
+        self.wl = self.dataSpectrum.wls[self.order_key][self.mask]
+        self.fl = self.dataSpectrum.fls[self.order_key][self.mask]
+        self.sigma = self.dataSpectrum.sigmas[self.order_key][self.mask]
         self.ndata = len(self.wl)
-        self.mask = self.dataSpectrum.masks[self.order_key]
         self.order = int(self.dataSpectrum.orders[self.order_key])
 
         self.logger = logging.getLogger("{} {}".format(self.__class__.__name__, self.order))
@@ -204,7 +239,7 @@ class Order:
         self.logger.info("Initializing model on Spectrum {}, order {}.".format(self.spectrum_id, self.order_key))
 
         self.npoly = Starfish.config["cheb_degree"]
-        self.chebyshevSpectrum = ChebyshevSpectrum(self.dataSpectrum, self.order_key, npoly=self.npoly)
+        self.chebyshevSpectrum = ChebyshevSpectrum(self.dataSpectrum, self.order_key, npoly=self.npoly, mask=self.mask)
 
         # If the file exists, optionally initiliaze to the chebyshev values
         fname = Starfish.specfmt.format(self.spectrum_id, self.order) + "phi.json"
@@ -216,7 +251,7 @@ class Order:
         self.resid_deque = deque(maxlen=500) #Deque that stores the last residual spectra, for averaging
         self.counter = 0
 
-        self.emulator = Emulator.open()
+        self.emulator = get_emulator()
         self.emulator.determine_chunk_log(self.wl)
 
         self.pca = self.emulator.pca
@@ -226,17 +261,76 @@ class Order:
         # The raw eigenspectra and mean flux components
         self.EIGENSPECTRA = np.vstack((self.pca.flux_mean[np.newaxis,:], self.pca.flux_std[np.newaxis,:], self.pca.eigenspectra))
 
+        # EIGENSPECTRA are fixed, so only take their FFT once
+        self.EIGENSPECTRA_FFT = np.fft.rfft(self.EIGENSPECTRA, axis=1)
+
         self.ss = np.fft.rfftfreq(self.pca.npix, d=self.emulator.dv)
         self.ss[0] = 0.01 # junk so we don't get a divide by zero error
 
-        # Holders to store the convolved and resampled eigenspectra
-        self.eigenspectra = np.empty((self.pca.m, self.ndata))
-        self.flux_mean = np.empty((self.ndata,))
-        self.flux_std = np.empty((self.ndata,))
-
-        self.sigma_mat = self.sigma**2 * np.eye(self.ndata)
+        # Cache of the vsini broadening kernels on ss
+        self.broadening = BroadeningKernel(self.ss)
+
+        # Sparse interpolation matrix from wl_FFT to the data pixels
+        self.resampler = Resampler(self.wl_FFT, self.wl)
+
+        # Optionally apply the Doppler shift in Fourier space, together with the
+        # vsini broadening, so that the resampling matrix never changes.
+        self.fourier_shift = Starfish.config.get("fourier_shift", False)
+
+        # Double buffered holders to store the convolved and resampled
+        # eigenspectra. Each proposal is written into the inactive buffer, so
+        # that accepting or reverting it only needs to flip an index.
+        # The resampled (flux_mean, flux_std, eigenspectra) before scaling by Omega
+        self.resampled_buffers = np.zeros((2, self.pca.m + 2, self.ndata))
+        # flux_mean and flux_std scaled by Omega
+        self.flux_buffers = np.zeros((2, 2, self.ndata))
+        self.resampled_index, self.flux_index = 0, 0
+
+        # Cached (vsini, eigenspectra_full) of the broadening
+        self.broadened = None
+
+        # Optionally marginalize the flux scale and the Chebyshev polynomial
+        # analytically in evaluate, with Gaussian priors on the fractional
+        # corrections to the current model, model * (1 + b0 + b1 T1 + b2 T2 + ...)
+        marginalize = Starfish.config.get("marginalize", None)
+        self.marginalize = self.allow_marginalize and marginalize is not None
+        nlinear = 0
+        if self.marginalize:
+            nlinear = self.npoly
+            # The design matrix columns (1, T1, T2, ...) that multiply the model
+            self.linear_basis = np.asfortranarray(np.column_stack((np.ones((self.ndata,)), self.chebyshevSpectrum.T.T)))
+            # The prior covariance of (emulator weights, b0, b1, ...)
+            self.marginal_C = np.zeros((self.pca.m + nlinear, self.pca.m + nlinear))
+            self.marginal_C[self.pca.m:, self.pca.m:] = np.diag(np.concatenate(([marginalize["Omega"]**2], marginalize["cheb"]**2 * np.ones((nlinear - 1,)))))
+
+        # Preallocated workspaces for evaluate, so that no large arrays are
+        # allocated for each likelihood call. X and iDX are in Fortran order,
+        # so that LAPACK can solve for them in place. If marginalizing, X holds
+        # the extra columns of the linear parameters after the eigenspectra.
+        self.X_work = np.empty((self.ndata, self.pca.m + nlinear), order="F")
+        self.iDX_work = np.empty((self.ndata, self.pca.m + nlinear), order="F")
+        self.R_work = np.empty((self.ndata,))
+        self.iDR_work = np.empty((self.ndata,))
+        self.pix_work = np.empty((self.ndata,))
+
+        # The Theta parameters that each stage of the model was last computed
+        # with, so that update_Theta only redoes the stages that changed
+        self.stage_params = {}
+
+        # The data covariance matrix is stored in lower banded form,
+        # data_mat[i - j, j] = C[i, j], since all of the kernels have compact
+        # support. White noise is a single band.
+        self.sigma_mat = (self.sigma**2)[np.newaxis, :]
         self.mus, self.C_GP, self.data_mat = None, None, None
 
+        # Cached (data_mat, factor, logdet) of the current and previous data matrix
+        self.data_factor, self.data_factor_last = None, None
+
+        # The (sigAmp, logAmp, l) that the current and previous data matrix were
+        # built from, and cached (logAmp, l, kernel_mat) of the global kernel
+        self.data_mat_params, self.data_mat_params_last = None, None
+        self.kernel_mat, self.kernel_mat_last = None, None
+
         self.lnprior = 0.0 # Modified and set by NuisanceSampler.lnprob
 
         # self.nregions = 0
@@ -263,6 +357,25 @@ class Order:
         '''
         return self.lnprob
 
+    @property
+    def resampled(self):
+        '''
+        The active resampled (flux_mean, flux_std, eigenspectra), before scaling by Omega.
+        '''
+        return self.resampled_buffers[self.resampled_index]
+
+    @property
+    def eigenspectra(self):
+        return self.resampled_buffers[self.resampled_index, 2:]
+
+    @property
+    def flux_mean(self):
+        return self.flux_buffers[self.flux_index, 0]
+
+    @property
+    def flux_std(self):
+        return self.flux_buffers[self.flux_index, 1]
+
     def lnprob_Theta(self, p):
         '''
         Update the model to the Theta parameters and then evaluate the lnprob.
@@ -281,35 +394,115 @@ class Order:
         '''
         Return the lnprob using the current version of the C_GP matrix, data matrix,
         and other intermediate products.
+
+        The covariance matrix CC = X.C_GP.X^T + data_mat is never formed. Instead,
+        the rank-m emulator term is applied to the cached factorization of the
+        data matrix (see :meth:`factor_data_mat`) using the Woodbury identity
+        and the matrix determinant lemma, so that only (m, m) matrices need
+        to be factored for each new set of Theta parameters.
+
+        If ``marginalize`` is set in the config file, the flux scale and the
+        Chebyshev polynomial are integrated out analytically. They enter the
+        mean model linearly, as model * (1 + b0 + b1 T1 + b2 T2 + ...), so they
+        are extra columns of the design matrix X with zero-mean Gaussian priors
+        on b, and go through the same Woodbury solve as the emulator weights.
         '''
 
         self.lnprob_last = self.lnprob
 
-        X = (self.chebyshevSpectrum.k * self.flux_std * np.eye(self.ndata)).dot(self.eigenspectra.T)
+        m = self.pca.m
+        k = self.chebyshevSpectrum.k
+        X, R, tmp = self.X_work, self.R_work, self.pix_work
+        XE = X[:, :m]
+
+        # Scale the rows of the eigenspectra, rather than multiplying by a diagonal matrix.
+        # One column at a time, because numpy allocates a buffer to broadcast
+        # into the Fortran ordered X.
+        np.multiply(k, self.flux_std, out=tmp)
+        for i, eigenspectrum in enumerate(self.eigenspectra):
+            np.multiply(tmp, eigenspectrum, out=XE[:, i])
+
+        # R = fl - k * flux_mean - X.mus
+        np.multiply(k, self.flux_mean, out=R)
+        np.subtract(self.fl, R, out=R)
+        np.dot(XE, self.mus, out=tmp)
+        R -= tmp
+
+        if self.marginalize:
+            # The mean model times (1, T1, T2, ...)
+            np.subtract(self.fl, R, out=tmp)
+            for i in range(self.linear_basis.shape[1]):
+                np.multiply(tmp, self.linear_basis[:, i], out=X[:, m + i])
+            C_X = self.marginal_C
+            C_X[:m, :m] = self.C_GP
+        else:
+            C_X = self.C_GP
 
-        CC = X.dot(self.C_GP.dot(X.T)) + self.data_mat
+        factor, logdet_D = self.factor_data_mat()
 
         try:
-            factor, flag = cho_factor(CC)
+            self.lnprob = woodbury_lnlike(factor, logdet_D, X, R, C_X, iDX=self.iDX_work, iDR=self.iDR_work)
+
+            self.logger.debug("Evaluating lnprob={}".format(self.lnprob))
+            return self.lnprob
+
+        # To give us some debugging information about what went wrong.
         except np.linalg.linalg.LinAlgError:
             print("Spectrum:", self.spectrum_id, "Order:", self.order)
-            self.CC_debugger(CC)
             raise
 
-        try:
-            R = self.fl - self.chebyshevSpectrum.k * self.flux_mean - X.dot(self.mus)
+    def factor_data_mat(self):
+        '''
+        Factor the banded data covariance matrix, returning (factor, logdet).
 
-            logdet = np.sum(2 * np.log((np.diag(factor))))
-            self.lnprob = -0.5 * (np.dot(R, cho_solve((factor, flag), R)) + logdet)
+        The data matrix only changes with the Phi parameters, so the result
+        is cached and reused across Theta proposals. The factorization of the
+        previous data matrix is also kept, so that reverting a Phi proposal
+        does not require refactoring.
 
-            self.logger.debug("Evaluating lnprob={}".format(self.lnprob))
-            return self.lnprob
+        See :func:`Starfish.covariance.factor_banded`.
+        '''
 
-        # To give us some debugging information about what went wrong.
+        if self.data_factor is not None and self.data_factor[0] is self.data_mat:
+            return self.data_factor[1:]
+
+        if self.data_factor_last is not None and self.data_factor_last[0] is self.data_mat:
+            self.data_factor, self.data_factor_last = self.data_factor_last, self.data_factor
+            return self.data_factor[1:]
+
+        try:
+            factor, logdet = factor_banded(self.data_mat)
         except np.linalg.linalg.LinAlgError:
             print("Spectrum:", self.spectrum_id, "Order:", self.order)
+            self.CC_debugger(banded_to_dense(self.data_mat))
             raise
 
+        self.data_factor_last = self.data_factor
+        self.data_factor = (self.data_mat, factor, logdet)
+        return (factor, logdet)
+
+    def get_kernel_mat(self, logAmp, l):
+        '''
+        Return the banded global covariance kernel for (logAmp, l), filled out
+        from ``self.pixel_distances``.
+
+        The kernels of the current and previous parameters are cached, so Phi
+        proposals that leave logAmp and l unchanged (or revert to them) do not
+        refill the matrix.
+        '''
+
+        if self.kernel_mat is not None and self.kernel_mat[:2] == (logAmp, l):
+            return self.kernel_mat[2]
+
+        if self.kernel_mat_last is not None and self.kernel_mat_last[:2] == (logAmp, l):
+            self.kernel_mat, self.kernel_mat_last = self.kernel_mat_last, self.kernel_mat
+            return self.kernel_mat[2]
+
+        kernel_mat = self.pixel_distances.get_C(logAmp, l, banded=True)
+        self.kernel_mat_last = self.kernel_mat
+        self.kernel_mat = (logAmp, l, kernel_mat)
+        return kernel_mat
+
     def CC_debugger(self, CC):
         '''
         Special debugging information for the covariance matrix decomposition.
@@ -346,6 +539,13 @@ class Order:
         '''
         Update the model to the current Theta parameters.
 
+        Only the stages of the model that depend on parameters which changed
+        from the current state are recomputed. A change in ``vz`` or ``vsini``
+        requires broadening and resampling the eigenspectra (a change in only
+        ``vz`` reuses the broadening, unless ``fourier_shift`` is set), a change
+        in ``logOmega`` only rescales them, and a change in ``grid`` only
+        queries the emulator.
+
         :param p: parameters to update model to
         :type p: model.ThetaParam
         '''
@@ -361,14 +561,11 @@ class Order:
         self.logger.debug("Updating Theta parameters to {}".format(p))
 
         # Store the current accepted values before overwriting with new proposed values.
-        self.flux_mean_last = self.flux_mean.copy()
-        self.flux_std_last = self.flux_std.copy()
-        self.eigenspectra_last = self.eigenspectra.copy()
+        self.resampled_index_last = self.resampled_index
+        self.flux_index_last = self.flux_index
         self.mus_last = self.mus
         self.C_GP_last = self.C_GP
-
-        # Local, shifted copy of wavelengths
-        wl_FFT = self.wl_FFT * np.sqrt((C.c_kms + p.vz) / (C.c_kms - p.vz))
+        self.stage_params_last = self.stage_params.copy()
 
         # If vsini is less than 0.2 km/s, we might run into issues with
         # the grid spacing. Therefore skip the convolution step if we have
@@ -376,50 +573,77 @@ class Order:
         # FFT and convolve operations
         if p.vsini < 0.0:
             raise C.ModelError("vsini must be positive")
-        elif p.vsini < 0.2:
-            # Skip the vsini taper due to instrumental effects
-            eigenspectra_full = self.EIGENSPECTRA.copy()
-        else:
-            FF = np.fft.rfft(self.EIGENSPECTRA, axis=1)
-
-            # Determine the stellar broadening kernel
-            ub = 2. * np.pi * p.vsini * self.ss
-            sb = j1(ub) / ub - 3 * np.cos(ub) / (2 * ub ** 2) + 3. * np.sin(ub) / (2 * ub ** 3)
-            # set zeroth frequency to 1 separately (DC term)
-            sb[0] = 1.
-
-            # institute vsini taper
-            FF_tap = FF * sb
 
-            # do ifft
-            eigenspectra_full = np.fft.irfft(FF_tap, self.pca.npix, axis=1)
+        shifted = (p.vz, p.vsini) != self.stage_params.get("shift")
+        if shifted:
+            # Local, shifted copy of wavelengths
+            wl_FFT = self.wl_FFT * np.sqrt((C.c_kms + p.vz) / (C.c_kms - p.vz))
 
-        # Spectrum resample operations
-        if min(self.wl) < min(wl_FFT) or max(self.wl) > max(wl_FFT):
-            raise RuntimeError("Data wl grid ({:.2f},{:.2f}) must fit within the range of wl_FFT ({:.2f},{:.2f})".format(min(self.wl), max(self.wl), min(wl_FFT), max(wl_FFT)))
+            # Spectrum resample operations
+            if min(self.wl) < min(wl_FFT) or max(self.wl) > max(wl_FFT):
+                raise RuntimeError("Data wl grid ({:.2f},{:.2f}) must fit within the range of wl_FFT ({:.2f},{:.2f})".format(min(self.wl), max(self.wl), min(wl_FFT), max(wl_FFT)))
 
-        # Take the output from the FFT operation (eigenspectra_full), and stuff them
-        # into respective data products
-        for lres, hres in zip(chain([self.flux_mean, self.flux_std], self.eigenspectra), eigenspectra_full):
-            interp = InterpolatedUnivariateSpline(wl_FFT, hres, k=5)
-            lres[:] = interp(self.wl)
-            del interp
+            if self.fourier_shift:
+                # The emulator grid is uniform in log-lambda, so the Doppler shift
+                # is a translation by the same (fractional) number of pixels
+                # everywhere, which is a phase ramp in Fourier space.
+                FF_tap = self.resampler.shift_FFT(self.EIGENSPECTRA_FFT, p.vz)
 
-        # Helps keep memory usage low, seems like the numpy routine is slow
-        # to clear allocated memory for each iteration.
-        gc.collect()
+                if p.vsini >= 0.2:
+                    # Determine the stellar broadening kernel
+                    sb = self.broadening(p.vsini)
 
-        # Adjust flux_mean and flux_std by Omega
-        Omega = 10**p.logOmega
-        self.flux_mean *= Omega
-        self.flux_std *= Omega
+                    # institute vsini taper
+                    FF_tap *= sb
 
+                # do ifft
+                eigenspectra_full = np.fft.irfft(FF_tap, self.pca.npix, axis=1)
 
-
-        # Now update the parameters from the emulator
-        # If pars are outside the grid, Emulator will raise C.ModelError
-        self.emulator.params = p.grid
-        self.mus, self.C_GP = self.emulator.matrix
+            else:
+                # Resample from the shifted grid. Only the interpolation weights
+                # change with vz, unless the shift moves across a pixel.
+                self.resampler.update(p.vz)
+
+                if self.broadened is None or self.broadened[0] != p.vsini:
+                    if p.vsini < 0.2:
+                        # Skip the vsini taper due to instrumental effects
+                        eigenspectra_full = self.EIGENSPECTRA
+                    else:
+                        # Determine the stellar broadening kernel
+                        sb = self.broadening(p.vsini)
+
+                        # institute vsini taper
+                        FF_tap = self.EIGENSPECTRA_FFT * sb
+
+                        # do ifft
+                        eigenspectra_full = np.fft.irfft(FF_tap, self.pca.npix, axis=1)
+
+                    self.broadened = (p.vsini, eigenspectra_full)
+
+                eigenspectra_full = self.broadened[1]
+
+            # Take the output from the FFT operation (eigenspectra_full), and
+            # resample all of the components onto the data pixels with a single
+            # sparse product, into the inactive buffer
+            self.resampled_index = 1 - self.resampled_index_last
+            self.resampled[:] = self.resampler.resample(eigenspectra_full)
+            self.stage_params["shift"] = (p.vz, p.vsini)
+
+        if shifted or p.logOmega != self.stage_params.get("logOmega"):
+            # Adjust flux_mean and flux_std by Omega
+            Omega = 10**p.logOmega
+            self.flux_index = 1 - self.flux_index_last
+            np.multiply(Omega, self.resampled[0], out=self.flux_mean)
+            np.multiply(Omega, self.resampled[1], out=self.flux_std)
+            self.stage_params["logOmega"] = p.logOmega
+
+        grid = tuple(p.grid)
+        if grid != self.stage_params.get("grid"):
+            # Now update the parameters from the emulator
+            # If pars are outside the grid, Emulator will raise C.ModelError
+            self.emulator.params = p.grid
+            self.mus, self.C_GP = self.emulator.matrix
+            self.stage_params["grid"] = grid
 
     def revert_Theta(self):
         '''
@@ -430,12 +654,13 @@ class Order:
 
         self.lnprob = self.lnprob_last
 
-        self.flux_mean = self.flux_mean_last
-        self.flux_std = self.flux_std_last
-        self.eigenspectra = self.eigenspectra_last
+        # Flip back to the buffers of the accepted model
+        self.resampled_index = self.resampled_index_last
+        self.flux_index = self.flux_index_last
 
         self.mus = self.mus_last
         self.C_GP = self.C_GP_last
+        self.stage_params = self.stage_params_last
 
     def decide_Theta(self, yes):
         '''
@@ -444,6 +669,10 @@ class Order:
 
         :param yes: if True, accept stellar parameters.
         :type yes: boolean
+
+        :returns: (float) the lnprob after the independent sampling, so that
+            the master process knows the current total without a separate
+            GET_LNPROB round trip.
         '''
         if yes:
             # accept and move on
@@ -456,19 +685,102 @@ class Order:
         # Proceed with independent sampling
         self.independent_sample(1)
 
+        return self.lnprob
+
+    def solve_cov(self, B):
+        '''
+        Solve CC x = B for the current covariance matrix CC = X.C_GP.X^T + data_mat,
+        using the same Woodbury identity as :meth:`evaluate`.
+
+        :param B: right hand side
+        :type B: 1D or 2D np.array
+        '''
+        X = (self.chebyshevSpectrum.k * self.flux_std)[:, np.newaxis] * self.eigenspectra.T
+
+        factor, logdet_D = self.factor_data_mat()
+        return woodbury_solve(factor, X, self.C_GP, B)
+
+    def solve_Cheb(self, c0=1.0, maxiter=20):
+        '''
+        Keeping the current Theta parameters and c0 fixed, find the Chebyshev
+        coefficients with a generalized least squares solve, and update the
+        Chebyshev spectrum to them.
+
+        The mean model k * (flux_mean + X'.mus), with k = c0 (1 + T^T c), is linear
+        in the coefficients c. The covariance matrix also depends on k through X,
+        so the solve is repeated with the updated covariance until it converges,
+        which typically takes a few iterations.
+
+        :param c0: the (fixed) c0 coefficient
+        :type c0: float
+        :param maxiter: maximum number of iterations
+        :type maxiter: int
+
+        :returns: (np.array) the coefficients c
+        '''
+        T = self.chebyshevSpectrum.T
+
+        # The mean model without the Chebyshev polynomial
+        f0 = self.flux_mean + self.flux_std * self.eigenspectra.T.dot(self.mus)
+
+        # fl - c0 f0 = A c + noise
+        A = c0 * (f0[:, np.newaxis] * T.T)
+        y = self.fl - c0 * f0
+
+        cns = np.zeros((len(T),))
+        for i in range(maxiter):
+            iCAy = self.solve_cov(np.column_stack((A, y)))
+            cns_new = np.linalg.solve(A.T.dot(iCAy[:, :-1]), A.T.dot(iCAy[:, -1]))
+
+            if self.chebyshevSpectrum.fix_c0:
+                self.chebyshevSpectrum.update(cns_new)
+            else:
+                self.chebyshevSpectrum.update(np.concatenate(([np.log10(c0)], cns_new)))
+
+            converged = np.allclose(cns_new, cns, rtol=1e-8, atol=1e-10)
+            cns = cns_new
+            if converged:
+                break
+
+        return cns
+
     def optimize_Cheb(self, *args):
         '''
         Keeping the current Theta parameters fixed and assuming white noise,
-        optimize the Chebyshev parameters
+        optimize the Chebyshev parameters.
+
+        The coefficients c1, c2, ... are first found analytically by
+        :meth:`solve_Cheb`. If c0 is not fixed, it is found by a 1D search over
+        log10(c0), solving for the other coefficients at each step.
+
+        The GLS solve maximizes the chi^2 term only. The emulator covariance
+        X C_GP X^T also scales with the Chebyshev polynomial, and so does its
+        log determinant, which leaves the analytic solution short of the
+        maximum of the full lnprob (typically by ~10). The solution is
+        therefore polished with a simplex search on the full lnprob. Starting
+        from the analytic solution, it converges in ~100-150 evaluations.
+        It is bounded to 200 iterations, with tolerances far below the
+        uncertainty of the coefficients.
         '''
 
         if self.chebyshevSpectrum.fix_c0:
-            p0 = np.zeros((self.npoly - 1))
             self.fix_c0 = True
+            p0 = self.solve_Cheb()
         else:
-            p0 = np.zeros((self.npoly))
             self.fix_c0 = False
 
+            def fc0(logc0):
+                self.solve_Cheb(10**logc0)
+                lnp = self.evaluate()
+                if lnp == -np.inf:
+                    return 1e99
+                else:
+                    return -lnp
+
+            from scipy.optimize import minimize_scalar
+            logc0 = minimize_scalar(fc0, bracket=(-0.1, 0.1)).x
+            p0 = np.concatenate(([logc0], self.solve_Cheb(10**logc0)))
+
         def fprob(p):
             self.chebyshevSpectrum.update(p)
             lnp = self.evaluate()
@@ -479,7 +791,7 @@ class Order:
                 return -lnp
 
         from scipy.optimize import fmin
-        result = fmin(fprob, p0, maxiter=10000, maxfun=10000)
+        result = fmin(fprob, p0, xtol=1e-6, ftol=1e-3, maxiter=200, maxfun=400)
         print(self.order, result)
 
         # Due to a JSON bug, np.int64 type objects will get read twice,
@@ -509,6 +821,7 @@ class Order:
 
         self.chebyshevSpectrum.revert()
         self.data_mat = self.data_mat_last
+        self.data_mat_params = self.data_mat_params_last
 
     def clear_resid_deque(self):
         '''
@@ -579,7 +892,7 @@ class Order:
         # communicated back to the master process.
         # Some commands sent to the child processes do not require a response
         # to the main process.
-        if response:
+        if response is not None:
             self.logger.debug("{} sending back {}".format(os.getpid(), response))
             self.conn.send(response)
         return True
@@ -590,7 +903,8 @@ class Order:
         residuals into a JSON.
         '''
 
-        X = (self.chebyshevSpectrum.k * self.flux_std * np.eye(self.ndata)).dot(self.eigenspectra.T)
+        # Scale the rows of the eigenspectra, rather than multiplying by a diagonal matrix
+        X = (self.chebyshevSpectrum.k * self.flux_std)[:, np.newaxis] * self.eigenspectra.T
 
         model = self.chebyshevSpectrum.k * self.flux_mean + X.dot(self.mus)
         resid = self.fl - model
@@ -614,6 +928,12 @@ class OptimizeTheta(Order):
 
 
 class OptimizeCheb(Order):
+    def __init__(self, debug=False):
+        super().__init__(debug)
+        # Optimize the Chebyshev coefficients themselves, rather than a
+        # likelihood which has already integrated them out
+        self.allow_marginalize = False
+
     def initialize(self, key):
         super().initialize(key)
         # Any additional setup here
@@ -659,8 +979,17 @@ class SampleThetaCheb(Order):
         '''
         self.chebyshevSpectrum.update(p)
 
+    def independent_sample(self, niter):
+        if self.marginalize:
+            # The Chebyshev coefficients are marginalized in evaluate, so there
+            # is nothing left to sample
+            return
+        super().independent_sample(niter)
+
     def finish(self, *args):
         super().finish(*args)
+        if self.marginalize:
+            return
         fname = Starfish.routdir + Starfish.specfmt.format(self.spectrum_id, self.order) + "/mc.hdf5"
         self.sampler.write(fname=fname)
 
@@ -682,22 +1011,30 @@ class SampleThetaPhi(Order):
         # are there
         phi.regions = None
 
+        # The pixel separations only depend on the wavelengths, so compute them
+        # once, with some room for l to grow, rather than at every update of Phi
+        self.pixel_distances = PixelDistances(self.wl, 1.5 * 6.0 * phi.l)
+
         #Loading file that was previously output
         # Convert PhiParam object to an array
         self.p0 = phi.toarray()
 
         jump = Starfish.config["Phi_jump"]
         cheb_len = (self.npoly - 1) if self.chebyshevSpectrum.fix_c0 else self.npoly
+        cheb_fixed = phi.cheb
+        if self.marginalize:
+            # The Chebyshev coefficients are marginalized in evaluate, so keep
+            # them fixed instead of sampling them
+            self.p0 = self.p0[cheb_len:]
+            cheb_len = 0
         cov_arr = np.concatenate((Starfish.config["cheb_jump"]**2 * np.ones((cheb_len,)), np.array([jump["sigAmp"], jump["logAmp"], jump["l"]])**2 ))
         cov = np.diag(cov_arr)
 
         def lnfunc(p):
             # Convert p array into a PhiParam object
-            ind = self.npoly
-            if self.chebyshevSpectrum.fix_c0:
-                ind -= 1
+            ind = cheb_len
 
-            cheb = p[0:ind]
+            cheb = cheb_fixed if self.marginalize else p[0:ind]
             sigAmp = p[ind]
             ind+=1
             logAmp = p[ind]
@@ -737,14 +1074,17 @@ class SampleThetaPhi(Order):
         #if p.sigAmp < 0.1:
         #   raise C.ModelError("sigAmp shouldn't be lower than 0.1, something is wrong.")
 
-        max_r = 6.0 * p.l # [km/s]
-
-        # Create a partial function which returns the proper element.
-        k_func = make_k_func(p)
-
         # Store the previous data matrix in case we want to revert later
         self.data_mat_last = self.data_mat
-        self.data_mat = get_dense_C(self.wl, k_func=k_func, max_r=max_r) + p.sigAmp*self.sigma_mat
+        self.data_mat_params_last = self.data_mat_params
+
+        # If only the Chebyshev coefficients changed, keep the same data matrix
+        # (and its cached factorization). If only sigAmp changed, reuse the kernel.
+        params = (p.sigAmp, p.logAmp, p.l)
+        if params != self.data_mat_params:
+            # The global kernel is filled out to 6 l [km/s]
+            self.data_mat = banded_sum(self.get_kernel_mat(p.logAmp, p.l), p.sigAmp*self.sigma_mat)
+            self.data_mat_params = params
 
     def finish(self, *args):
         super().finish(*args)
@@ -768,12 +1108,11 @@ class SampleThetaPhiLines(Order):
         # print("Phi.regions", phi.regions)
         # import sys
         # sys.exit()
-        # Get the regions matrix
-        region_func = make_k_func_region(phi)
-
-        max_r = 4.0 * np.max(phi.regions, axis=0)[2]
-
-        self.region_mat = get_dense_C(self.wl, k_func=region_func, max_r=max_r)
+        # Get the regions matrix, filled out to 4 sigma of the widest region
+        # The pixel separations only depend on the wavelengths, so compute them
+        # once, with some room for l to grow, rather than at every update of Phi
+        self.pixel_distances = PixelDistances(self.wl, max(1.5 * 6.0 * phi.l, 4.0 * np.max(phi.regions[:, 2])))
+        self.region_mat = self.pixel_distances.get_C(regions=phi.regions, banded=True)
 
         print(self.region_mat)
 
@@ -786,16 +1125,20 @@ class SampleThetaPhiLines(Order):
 
         jump = Starfish.config["Phi_jump"]
         cheb_len = (self.npoly - 1) if self.chebyshevSpectrum.fix_c0 else self.npoly
+        cheb_fixed = phi.cheb
+        if self.marginalize:
+            # The Chebyshev coefficients are marginalized in evaluate, so keep
+            # them fixed instead of sampling them
+            self.p0 = self.p0[cheb_len:]
+            cheb_len = 0
         cov_arr = np.concatenate((Starfish.config["cheb_jump"]**2 * np.ones((cheb_len,)), np.array([jump["sigAmp"], jump["logAmp"], jump["l"]])**2 ))
         cov = np.diag(cov_arr)
 
         def lnfunc(p):
             # Convert p array into a PhiParam object
-            ind = self.npoly
-            if self.chebyshevSpectrum.fix_c0:
-                ind -= 1
+            ind = cheb_len
 
-            cheb = p[0:ind]
+            cheb = cheb_fixed if self.marginalize else p[0:ind]
             sigAmp = p[ind]
             ind+=1
             logAmp = p[ind]
@@ -825,14 +1168,17 @@ class SampleThetaPhiLines(Order):
         if phi.sigAmp < 0.1:
             raise C.ModelError("sigAmp shouldn't be lower than 0.1, something is wrong.")
 
-        max_r = 6.0 * phi.l # [km/s]
-
-        # Create a partial function which returns the proper element.
-        k_func = make_k_func(phi)
-
         # Store the previous data matrix in case we want to revert later
         self.data_mat_last = self.data_mat
-        self.data_mat = get_dense_C(self.wl, k_func=k_func, max_r=max_r) + phi.sigAmp*self.sigma_mat + self.region_mat
+        self.data_mat_params_last = self.data_mat_params
+
+        # If only the Chebyshev coefficients changed, keep the same data matrix
+        # (and its cached factorization). If only sigAmp changed, reuse the kernel.
+        params = (phi.sigAmp, phi.logAmp, phi.l)
+        if params != self.data_mat_params:
+            # The global kernel is filled out to 6 l [km/s]
+            self.data_mat = banded_sum(self.get_kernel_mat(phi.logAmp, phi.l), phi.sigAmp*self.sigma_mat, self.region_mat)
+            self.data_mat_params = params
 
     def finish(self, *args):
         super().finish(*args)
@@ -932,24 +1278,192 @@ class SampleThetaPhiLines(Order):
 # Then, each forked model will be customized using an INIT command passed
 # through the PIPE.
 
-def initialize(model):
-    # Fork a subprocess for each key: (spectra, order)
+class Worker:
+    def __init__(self, model):
+        '''
+        A subprocess which evaluates several echelle orders in sequence, so that
+        the number of processes does not have to grow with the number of
+        orders. Like :class:`Order`, it is instantiated in the main process and
+        then forked. The `INIT` message carries the list of keys to initialize,
+        and each order gets its own instance of the same class as `model`.
+
+        :param model: template of the order model, e.g. SampleThetaPhi
+        :type model: Order
+        '''
+        self.model = model
+        self.orders = []
+
+    def initialize(self, keys):
+        '''
+        Initialize one order model for each key.
+
+        :param keys: list of (spectrum_id, order_key)
+        '''
+        for key in keys:
+            order = self.model.__class__(debug=self.model.debug)
+            order.initialize(key)
+            self.orders.append(order)
+
+    def interpret(self):
+        '''
+        Pass the message on to each order in turn. If the orders respond, send
+        back the sum of their responses, which is how the master process
+        combines the lnprob of all orders anyway.
+        '''
+        fname, arg = self.conn.recv() # Waits here to receive a new message
+
+        if fname == "INIT":
+            self.initialize(arg)
+            return True
+
+        if fname not in self.model.func_dict:
+            return False
+
+        response = None
+        for order in self.orders:
+            lnp = order.func_dict[fname](arg)
+            if lnp is not None:
+                response = lnp if response is None else response + lnp
+
+        if response is not None:
+            self.conn.send(response)
+        return True
+
+    def brain(self, conn):
+        '''
+        The infinite loop of the subprocess, which continues to listen for
+        messages on the pipe.
+        '''
+        self.conn = conn
+        alive = True
+        while alive:
+            alive = self.interpret()
+        self.conn.send("DEAD")
+
+def order_cost(key, m):
+    '''
+    Estimate the relative cost of evaluating the lnprob for one order. The
+    banded Cholesky factorization of the data covariance costs O(N p^2) for p
+    bands, and the Woodbury solve against the N x m eigenspectra O(N m^2), so
+    the cost is linear in the number of unmasked pixels N.
+
+    The number of bands is estimated from the initial global kernel length
+    l in config.yaml, which spans 6 l.
+
+    :param key: (spectrum_id, order_key)
+    :param m: number of eigenspectra
+    '''
+    spectrum_id, order_key = key
+    dataSpectrum = DataSpectra[spectrum_id]
+    wl = dataSpectrum.wls[order_key][np.asarray(dataSpectrum.masks[order_key], dtype=bool)]
+    N = len(wl)
+    dv = C.c_kms * np.median(np.diff(np.log(wl))) # km/s per pixel
+    p = np.ceil(6.0 * Starfish.config["Phi"]["l"] / dv)
+    return N * (p**2 + m**2)
+
+def assign_orders(keys, nworkers, m):
+    '''
+    Distribute the orders among the workers so that the estimated cost of each
+    worker is roughly equal, by always giving the next most expensive order to
+    the least loaded worker.
+
+    :param keys: list of (spectrum_id, order_key)
+    :param nworkers: number of worker processes
+    :param m: number of eigenspectra
+
+    :returns: list of length nworkers, with the list of keys for each worker
+    '''
+    costs = {key: order_cost(key, m) for key in keys}
+    assignments = [[] for i in range(nworkers)]
+    loads = np.zeros((nworkers,))
+    for key in sorted(keys, key=costs.get, reverse=True):
+        i = np.argmin(loads)
+        assignments[i].append(key)
+        loads[i] += costs[key]
+    return assignments
+
+def spawn_pipes(model, nworkers):
+    '''
+    Fork the worker subprocesses on this host, connected by pipes. The workers
+    are always forked, whatever the default start method, see
+    :func:`Starfish.transport.fork_context`.
+    '''
+    context = fork_context()
     pconns = {} # Parent connections
     cconns = {} # Child connections
     ps = {} # Process objects
     # Create all of the pipes
-    for spectrum_key in spectra_keys:
-        for order_key in order_keys:
-            pconn, cconn = Pipe()
-            key = (spectrum_key, order_key)
-            pconns[key], cconns[key] = pconn, cconn
-            p = Process(target=model.brain, args=(cconn,))
-            p.start()
-            ps[key] = p
-
-    # initialize each Model to a specific DataSpectrum and echelle order
-    for key, pconn in pconns.items():
-        pconn.send(("INIT", key))
+    for i in range(nworkers):
+        pconn, cconn = context.Pipe()
+        buffer = SharedConnection.allocate(len(Starfish.parname))
+        pconn, cconn = SharedConnection(pconn, buffer), SharedConnection(cconn, buffer)
+        pconns[i], cconns[i] = pconn, cconn
+        p = context.Process(target=Worker(model).brain, args=(cconn,))
+        p.start()
+        ps[i] = p
+
+    return (pconns, cconns, ps)
+
+def spawn_mpi(model, nworkers):
+    '''
+    Use the other MPI processes as the workers, which may be spread over
+    several nodes. Rank 0 is the master process, and every other rank runs the
+    message loop of a :class:`Worker` and exits once it is told to die, so
+    that only the master continues with the calling script. Ranks beyond
+    `nworkers` are idle and are told to die right away.
+
+    Launch with e.g. ``mpirun -n 4 star.py --sample=ThetaPhi``
+    '''
+    comm = MPI.COMM_WORLD
+
+    if comm.size < 2:
+        raise RuntimeError("The MPI transport needs at least 2 processes, only found {}.".format(comm.size))
+
+    if comm.rank > 0:
+        Worker(model).brain(MPIConnection(comm, 0))
+        sys.exit()
+
+    pconns = {} # Parent connections
+    ps = {} # Stand-ins for the Process objects
+    for rank in range(1, comm.size):
+        conn = MPIConnection(comm, rank)
+        if rank <= nworkers:
+            pconns[rank - 1] = conn
+        else:
+            conn.send(("DIE", None))
+        ps[rank - 1] = MPIProcess(conn)
+
+    # The child ends live in the other processes
+    return (pconns, {}, ps)
+
+def initialize(model):
+    '''
+    Start the workers and initialize their orders. With the default `pipe`
+    transport, the workers are forked on this host, and their number is set
+    by the `nworkers` field in config.yaml (default: the number of cores).
+    With the `mpi` transport, every MPI process other than rank 0 is a worker.
+    Each worker replies to a message with the sum over its orders.
+
+    :returns: (pconns, cconns, ps), dictionaries keyed by worker index
+    '''
+    keys = [(spectrum_key, order_key) for spectrum_key in spectra_keys for order_key in order_keys]
+
+    # Build the emulator before forking, so that every order shares its arrays
+    m = get_emulator().pca.m
+
+    transport = Starfish.config.get("transport", "pipe")
+    if transport == "mpi":
+        nworkers = min(MPI.COMM_WORLD.size - 1, len(keys))
+        pconns, cconns, ps = spawn_mpi(model, nworkers)
+    elif transport == "pipe":
+        nworkers = min(Starfish.config.get("nworkers", os.cpu_count()), len(keys))
+        pconns, cconns, ps = spawn_pipes(model, nworkers)
+    else:
+        raise RuntimeError("Unknown transport {}, choose pipe or mpi.".format(transport))
+
+    # initialize each worker to its share of the DataSpectra and echelle orders
+    for i, worker_keys in enumerate(assign_orders(keys, nworkers, m)):
+        pconns[i].send(("INIT", worker_keys))
 
     return (pconns, cconns, ps)
 
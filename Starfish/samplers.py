@@ -48,12 +48,24 @@ class StateSampler(Sampler):
         A list of extra keyword arguments for ``lnpostfn``. ``lnpostfn``
         will be called with the sequence ``lnpostfn(p, *args, **kwargs)``.
 
+    :param block: (optional)
+        Indices of the parameters that are cheap to update, because the model
+        reuses its cached intermediates when only they change. If given,
+        ``nblock`` proposals of only these parameters are made after every
+        proposal of all of the parameters.
+
+    :param nblock: (optional)
+        The number of proposals of the ``block`` parameters for every proposal
+        of all of the parameters.
+
     """
     def __init__(self, lnprob, p0, cov, query_lnprob=None, rejectfn=None,
-        acceptfn=None, debug=False, outdir="", *args, **kwargs):
+        acceptfn=None, debug=False, outdir="", block=None, nblock=0, *args, **kwargs):
         dim = len(p0)
         super().__init__(dim, lnprob, *args, **kwargs)
         self.cov = cov
+        self.block = None if block is None else np.asarray(block, dtype=int)
+        self.nblock = nblock if block is not None else 0
         self.p0 = p0
         self.query_lnprob = query_lnprob
         self.rejectfn = rejectfn
@@ -144,6 +156,11 @@ class StateSampler(Sampler):
             # Calculate the proposal distribution.
             if self.dim == 1:
                 q = self._random.normal(loc=p[0], scale=self.cov[0], size=(1,))
+            elif self.nblock and self.iterations % (self.nblock + 1) != 1:
+                # Only propose the cheap parameters, from their block of the covariance
+                q = p.copy()
+                q[self.block] = self._random.multivariate_normal(p[self.block],
+                    self.cov[np.ix_(self.block, self.block)])
             else:
                 q = self._random.multivariate_normal(p, self.cov)
 
@@ -20,13 +20,12 @@ import numpy as np
 import Starfish
 import Starfish.grid_tools
 from Starfish.samplers import StateSampler
-from Starfish.spectrum import DataSpectrum, Mask, ChebyshevSpectrum, create_mask
+from Starfish.spectrum import DataSpectrum, Mask, ChebyshevSpectrum, create_mask, BroadeningKernel
 from Starfish.emulator import Emulator
 import Starfish.constants as C
 from Starfish.covariance import get_dense_C, make_k_func, make_k_func_region
 from Starfish.model import ThetaParam, PhiParam
 
-from scipy.special import j1
 from scipy.interpolate import InterpolatedUnivariateSpline
 from scipy.linalg import cho_factor, cho_solve
 from numpy.linalg import slogdet
@@ -123,9 +122,15 @@ print(wl_FFT_orig[0], wl_FFT_orig[-1])
 # The raw eigenspectra and mean flux components
 EIGENSPECTRA = np.vstack((pca.flux_mean[np.newaxis,:], pca.flux_std[np.newaxis,:], pca.eigenspectra))
 
+# EIGENSPECTRA are fixed, so only take their FFT once
+EIGENSPECTRA_FFT = np.fft.rfft(EIGENSPECTRA, axis=1)
+
 ss = np.fft.rfftfreq(pca.npix, d=emulator.dv)
 ss[0] = 0.01 # junk so we don't get a divide by zero error
 
+# Cache of the vsini broadening kernels on ss
+broadening = BroadeningKernel(ss)
+
 sigma_mat = sigma**2 * np.eye(ndata)
 mus, C_GP, data_mat = None, None, None
 
@@ -154,16 +159,11 @@ def lnprob(p):
         # Skip the vsini taper due to instrumental effects
         eigenspectra_full = EIGENSPECTRA.copy()
     else:
-        FF = np.fft.rfft(EIGENSPECTRA, axis=1)
-
         # Determine the stellar broadening kernel
-        ub = 2. * np.pi * vsini * ss
-        sb = j1(ub) / ub - 3 * np.cos(ub) / (2 * ub ** 2) + 3. * np.sin(ub) / (2 * ub ** 3)
-        # set zeroth frequency to 1 separately (DC term)
-        sb[0] = 1.
+        sb = broadening(vsini)
 
         # institute vsini taper
-        FF_tap = FF * sb
+        FF_tap = EIGENSPECTRA_FFT * sb
 
         # do ifft
         eigenspectra_full = np.fft.irfft(FF_tap, pca.npix, axis=1)
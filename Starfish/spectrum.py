@@ -11,6 +11,7 @@ import Starfish.constants as C
 from Starfish.covariance import get_dense_C
 from scipy.linalg import cho_factor, cho_solve
 import copy
+from collections import OrderedDict
 
 log_lam_kws = frozenset(("CDELT1", "CRVAL1", "NAXIS1"))
 flux_units = frozenset(("f_lam", "f_nu"))
@@ -280,11 +281,14 @@ class ChebyshevSpectrum:
 
     :param DataSpectrum: take shape from.
     :type DataSpectrum: :obj:`DataSpectrum` object
+    :param mask: if provided, only keep the pixels where the mask is True. The
+        polynomials are still defined over the full order.
+    :type mask: 1D np.array of boolean values
 
     If DataSpectrum.norders == 1, then only c1, c2, and c3 are required. Otherwise c0 is also reqired for each order.
     '''
 
-    def __init__(self, DataSpectrum, index, npoly=4):
+    def __init__(self, DataSpectrum, index, npoly=4, mask=None):
         self.wl = DataSpectrum.wls[index]
         len_wl = len(self.wl)
 
@@ -313,6 +317,11 @@ class ChebyshevSpectrum:
         # self.T = np.array([T1, T2, T3])
         self.T = np.array(T)
         self.npoly = npoly
+
+        if mask is not None:
+            self.wl = self.wl[mask]
+            self.T = self.T[:, mask]
+            len_wl = len(self.wl)
         # assert self.npoly == 4, "Only handling order 4 Chebyshev for now."
 
         #Dummy holders for a flat spectrum
@@ -356,3 +365,210 @@ class ChebyshevSpectrum:
 
     def revert(self):
         self.k = self.k_last
+
+class Resampler:
+    '''
+    Linear operator that resamples spectra from a wavelength grid spaced uniformly
+    in log-lambda (such as the emulator grid) onto the data wavelengths, using
+    local Lagrange interpolation. The interpolation weights are stored as a
+    sparse matrix, so that many spectra can be resampled with a single product.
+
+    :param wl_FFT: wavelength grid spaced uniformly in log-lambda (in AA)
+    :type wl_FFT: 1D np.array
+    :param wl: wavelengths to resample onto (in AA)
+    :type wl: 1D np.array
+    :param k: degree of the interpolating polynomials, using k + 1 grid points for each wavelength
+    :type k: int
+    '''
+    def __init__(self, wl_FFT, wl, k=5):
+        self.npix = len(wl_FFT)
+        self.ndata = len(wl)
+        self.k = k
+
+        self.lnwl0 = np.log(wl_FFT[0])
+        self.dlnwl = (np.log(wl_FFT[-1]) - self.lnwl0) / (self.npix - 1)
+
+        # The (fractional) pixel positions of the data wavelengths in wl_FFT
+        self.x = (np.log(wl) - self.lnwl0) / self.dlnwl
+
+        # The denominators of the Lagrange basis polynomials on the nodes 0, ..., k
+        nodes = np.arange(k + 1)
+        self.denom = np.array([np.prod([j - m for m in nodes if m != j]) for j in nodes], dtype=np.float64)
+
+        self.vz = None
+        self.start = None
+        self.update(0.0)
+
+    def pixel_shift(self, vz):
+        '''
+        The Doppler shift of a spectrum on ``wl_FFT`` as a number of pixels. Because the
+        grid is uniform in log-lambda, this is the same translation for every pixel.
+
+        :param vz: radial velocity (in km/s)
+        :type vz: float
+
+        :returns: (float) shift in pixels
+        '''
+        return 0.5 * np.log((C.c_kms + vz) / (C.c_kms - vz)) / self.dlnwl
+
+    def shift_FFT(self, FF, vz):
+        '''
+        Doppler shift spectra on ``wl_FFT`` in Fourier space. The shift is the same
+        translation by :meth:`pixel_shift` pixels everywhere, which is a phase ramp.
+        Resampling the inverse transform with the unshifted matrix is then equivalent
+        to :meth:`update` with ``vz``, for band-limited spectra.
+
+        :param FF: real FFT of the spectra along the last axis
+        :type FF: np.array
+        :param vz: radial velocity (in km/s)
+        :type vz: float
+
+        :returns: (np.array) real FFT of the shifted spectra
+        '''
+        freq = np.fft.rfftfreq(self.npix) # cycles per pixel
+        return FF * np.exp(-2j * np.pi * self.pixel_shift(vz) * freq)
+
+    def update(self, vz):
+        '''
+        Build the resampling matrix for spectra on ``wl_FFT`` that have been Doppler
+        shifted by ``vz``, i.e., sampled on ``wl_FFT * sqrt((c + vz)/(c - vz))``.
+
+        Only the interpolation weights depend on the fractional part of the shift,
+        so the sparsity pattern of the matrix is reused until the shift moves a
+        wavelength across a pixel.
+
+        :param vz: radial velocity (in km/s)
+        :type vz: float
+        '''
+        if vz == self.vz:
+            return
+        self.vz = vz
+
+        t = self.x - self.pixel_shift(vz)
+
+        # The first of the k + 1 grid points around each wavelength, keeping all
+        # of them within the grid
+        start = np.floor(t).astype(np.int64) - (self.k // 2)
+        start = np.clip(start, 0, self.npix - self.k - 1)
+        u = t - start
+
+        weights = np.empty((self.ndata, self.k + 1))
+        for j in range(self.k + 1):
+            w = np.ones_like(u)
+            for m in range(self.k + 1):
+                if m != j:
+                    w *= (u - m)
+            weights[:, j] = w / self.denom[j]
+
+        if self.start is not None and np.array_equal(start, self.start):
+            self.matrix.data[:] = weights.ravel()
+            return
+
+        self.start = start
+        indices = start[:, np.newaxis] + np.arange(self.k + 1)
+        indptr = np.arange(0, self.ndata * (self.k + 1) + 1, self.k + 1)
+        self.matrix = sp.csr_matrix((weights.ravel(), indices.ravel(), indptr), shape=(self.ndata, self.npix))
+
+    def resample(self, fls):
+        '''
+        Resample spectra from ``wl_FFT`` onto the data wavelengths.
+
+        :param fls: spectra sampled on ``wl_FFT``
+        :type fls: 1D or 2D np.array, with rows of length ``len(wl_FFT)``
+
+        :returns: (np.array) spectra sampled on ``wl``
+        '''
+        return self.matrix.dot(fls.T).T
+
+class BroadeningKernel:
+    '''
+    The rotational broadening kernel in Fourier space, on a fixed frequency axis.
+
+    The kernels are evaluated on a grid in vsini and linearly interpolated in
+    between, with a least-recently-used cache of the kernels on the grid. A
+    sampler moving vsini in small steps then only evaluates a new kernel when it
+    crosses into a new grid cell, and the broadened model stays continuous in vsini.
+
+    The kernel is a function of u = 2 pi vsini s alone, with |d^2 sb/du^2| <=
+    0.225 (at u = 0), so linear interpolation over a step h in vsini is wrong by
+    at most h^2 / 8 (2 pi s_max)^2 0.225. The grid step is chosen to keep this
+    below ``tol``. Since the kernel multiplies the Fourier transform of the
+    spectrum, ``tol`` also bounds the rms fractional error of the broadened
+    spectrum, and the default of 1e-4 is well below the noise of the data.
+
+    :param ss: frequencies (in cycles per km/s), e.g. from ``np.fft.rfftfreq(npix, d=dv)``
+    :type ss: 1D np.array
+    :param tol: maximum absolute error of the interpolated kernel
+    :type tol: float
+    :param maxsize: number of kernels to keep
+    :type maxsize: int
+    '''
+    def __init__(self, ss, tol=1e-4, maxsize=32):
+        self.ss = ss.copy()
+        self.ss[0] = 0.01 # junk so we don't get a divide by zero error
+        self.tol = tol
+        self.maxsize = maxsize
+        self.step = np.sqrt(8 * tol / (0.225 * (2. * np.pi * np.max(np.abs(ss)))**2))
+        self.cache = OrderedDict()
+        self.kernel = np.empty_like(self.ss)
+
+    def evaluate(self, vsini):
+        '''
+        Evaluate the broadening kernel exactly.
+
+        :param vsini: rotational velocity (in km/s)
+        :type vsini: float
+
+        :returns: (np.array) kernel on ``ss``
+        '''
+        ub = 2. * np.pi * vsini * self.ss
+        sb = j1(ub) / ub - 3 * np.cos(ub) / (2 * ub ** 2) + 3. * np.sin(ub) / (2 * ub ** 3)
+        # set zeroth frequency to 1 separately (DC term)
+        sb[0] = 1.
+        return sb
+
+    def grid_kernel(self, index):
+        '''
+        Return the kernel at the grid point ``index * step``, from the cache if possible.
+        '''
+        sb = self.cache.get(index)
+        if sb is not None:
+            self.cache.move_to_end(index)
+            return sb
+
+        sb = self.evaluate(index * self.step)
+        sb.flags.writeable = False
+
+        self.cache[index] = sb
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return sb
+
+    def __call__(self, vsini):
+        '''
+        Return the broadening kernel for ``vsini``, interpolated between the two
+        nearest grid points. The returned array is overwritten by the next call.
+
+        :param vsini: rotational velocity (in km/s)
+        :type vsini: float
+
+        :returns: (np.array) kernel on ``ss``
+        '''
+        x = vsini / self.step
+        index = int(np.floor(x))
+        w = x - index
+
+        np.multiply(self.grid_kernel(index), 1. - w, out=self.kernel)
+        self.kernel += w * self.grid_kernel(index + 1)
+        return self.kernel
+
+        ub = 2. * np.pi * (key * self.tol) * self.ss
+        sb = j1(ub) / ub - 3 * np.cos(ub) / (2 * ub ** 2) + 3. * np.sin(ub) / (2 * ub ** 3)
+        # set zeroth frequency to 1 separately (DC term)
+        sb[0] = 1.
+        sb.flags.writeable = False
+
+        self.cache[key] = sb
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return sb
@@ -0,0 +1,135 @@
+# Connections between the master process and the worker processes, which
+# carry the messages of the protocol in parallel.py.
+
+import multiprocessing
+from multiprocessing import RawArray
+import pickle
+import numpy as np
+
+from Starfish.model import ThetaParam
+
+class SharedConnection:
+    # Single byte codes for the messages on the hot path of the sampling, whose
+    # arguments are passed through the shared buffer rather than pickled
+    REPLY = 0
+    LNPROB = 1
+    ACCEPT = 2
+    REJECT = 3
+    GET_LNPROB = 4
+
+    def __init__(self, conn, buffer):
+        '''
+        Wrap one end of a `multiprocessing.Pipe`, so that the LNPROB, DECIDE and
+        GET_LNPROB commands and the lnprob replies are sent as a single byte,
+        with the ThetaParam or lnprob written into a buffer shared by both ends.
+        All other messages are pickled as usual.
+
+        Because each command is answered before the next one writes to the
+        buffer, both ends can share the same buffer without locking.
+
+        :param conn: one end of a Pipe
+        :param buffer: shared buffer from :meth:`allocate`
+        '''
+        self.conn = conn
+        self.buffer = np.frombuffer(buffer, dtype=np.float64)
+
+    @staticmethod
+    def allocate(ngrid):
+        '''
+        Allocate the shared buffer for one pipe, which must happen before
+        forking. The layout is [vz, vsini, logOmega, Av, grid..., lnprob].
+
+        :param ngrid: number of grid parameters
+        :type ngrid: int
+        '''
+        return RawArray("d", ngrid + 5)
+
+    def send(self, obj):
+        if isinstance(obj, float):
+            self.buffer[-1] = obj
+            code = self.REPLY
+        elif isinstance(obj, tuple) and obj[0] == "LNPROB":
+            p = obj[1]
+            self.buffer[:4] = (p.vz, p.vsini, p.logOmega, p.Av)
+            self.buffer[4:-1] = p.grid
+            code = self.LNPROB
+        elif isinstance(obj, tuple) and obj[0] == "DECIDE":
+            code = self.ACCEPT if obj[1] else self.REJECT
+        elif isinstance(obj, tuple) and obj[0] == "GET_LNPROB":
+            code = self.GET_LNPROB
+        else:
+            self.conn.send(obj)
+            return
+
+        self.conn.send_bytes(bytes((code,)))
+
+    def recv(self):
+        msg = self.conn.recv_bytes()
+        # A pickled message is never a single byte
+        if len(msg) > 1:
+            return pickle.loads(msg)
+
+        code = msg[0]
+        if code == self.REPLY:
+            return self.buffer[-1]
+        elif code == self.LNPROB:
+            vz, vsini, logOmega, Av = self.buffer[:4]
+            return ("LNPROB", ThetaParam(grid=self.buffer[4:-1].copy(), vz=vz, vsini=vsini, logOmega=logOmega, Av=Av))
+        elif code == self.ACCEPT:
+            return ("DECIDE", True)
+        elif code == self.REJECT:
+            return ("DECIDE", False)
+        elif code == self.GET_LNPROB:
+            return ("GET_LNPROB", None)
+
+class MPIConnection:
+    def __init__(self, comm, rank):
+        '''
+        One end of a connection between two MPI processes, with the same
+        interface as the ends of a `multiprocessing.Pipe`, so that the master
+        and :class:`Worker` can use either one.
+
+        :param comm: MPI communicator
+        :param rank: rank of the process on the other end
+        :type rank: int
+        '''
+        self.comm = comm
+        self.rank = rank
+
+    def send(self, obj):
+        self.comm.send(obj, dest=self.rank)
+
+    def recv(self):
+        return self.comm.recv(source=self.rank)
+
+class MPIProcess:
+    def __init__(self, conn):
+        '''
+        Stand-in for the `multiprocessing.Process` of a worker running in
+        another MPI process. Joining waits for the worker to report that it has
+        exited its message loop.
+
+        :param conn: connection to the worker
+        :type conn: MPIConnection
+        '''
+        self.conn = conn
+
+    def join(self):
+        self.conn.recv() # "DEAD"
+
+    def terminate(self):
+        pass
+
+def fork_context():
+    '''
+    Return the multiprocessing context which forks the worker processes. The
+    workers must be forked, rather than started with the `spawn` or
+    `forkserver` methods that are the default on some platforms and Python
+    versions, so that they share the emulator and the pipe buffers set up by
+    the master (copy-on-write) instead of pickling or re-reading them.
+
+    :raises RuntimeError: if this platform cannot fork
+    '''
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("The pipe transport forks the worker processes, which is not supported on this platform. Use the mpi transport instead.")
+    return multiprocessing.get_context("fork")
@@ -118,7 +118,8 @@ if args.plot == "priors":
 # If we're doing optimization, period, set up some variables and the lnprob
 if args.optimize:
     my_pca = emulator.PCAGrid.open()
-    PhiPhi = np.linalg.inv(emulator.skinny_kron(my_pca.eigenspectra, my_pca.M))
+    # The inverse of Phi^T Phi, computed in closed form from its Kronecker structure
+    PhiPhi = emulator.KronIdentity.from_eigenspectra(my_pca.eigenspectra, my_pca.M).inv().todense()
     priors = Starfish.PCA["priors"]
 
     def lnprob(p, fmin=False):
@@ -16,7 +16,7 @@ if args.generate:
 
     pars = ThetaParam.from_dict(Starfish.config["Theta"])
 
-    for ((spectrum_id, order_id), pconn) in pconns.items():
+    for pconn in pconns.values():
         #Parse the parameters into what needs to be sent to each Model here.
         pconn.send(("LNPROB", pars))
         pconn.recv() # Receive and discard the answer so we can send the save
@@ -52,12 +52,12 @@ if args.optimize == "Theta":
         pars = ThetaParam(grid=p[0:3], vz=p[3], vsini=p[4], logOmega=p[5])
 
         #Distribute the calculation to each process
-        for ((spectrum_id, order_id), pconn) in pconns.items():
+        for pconn in pconns.values():
             #Parse the parameters into what needs to be sent to each Model here.
             pconn.send(("LNPROB", pars))
 
         #Collect the answer from each process
-        lnps = np.empty((len(Starfish.data["orders"]),))
+        lnps = np.empty((len(pconns),))
         for i, pconn in enumerate(pconns.values()):
             lnps[i] = pconn.recv()
 
@@ -120,7 +120,7 @@ if args.optimize == "Cheb":
     pars = ThetaParam.from_dict(Starfish.config["Theta"])
 
     #Distribute the calculation to each process
-    for ((spectrum_id, order_id), pconn) in pconns.items():
+    for pconn in pconns.values():
         #Parse the parameters into what needs to be sent to each Model here.
         pconn.send(("LNPROB", pars))
         pconn.recv() # Receive and discard the answer so we can send the optimize
@@ -150,44 +150,56 @@ if args.sample == "ThetaCheb" or args.sample == "ThetaPhi" or args.sample == "Th
 
     pconns, cconns, ps = parallel.initialize(model)
 
+    # The current total lnprob, as reported back by the orders along with
+    # their DECIDE acknowledgement.
+    lnprob_current = None
+
     # These functions store the variables pconns, cconns, ps.
+    def gather_lnprob():
+        #Collect the answer from each process
+        lnps = np.empty((len(pconns),))
+        for i, pconn in enumerate(pconns.values()):
+            lnps[i] = pconn.recv()
+        return np.sum(lnps) # + lnprior
+
     def lnprob(p):
         pars = ThetaParam(grid=p[0:3], vz=p[3], vsini=p[4], logOmega=p[5])
         #Distribute the calculation to each process
-        for ((spectrum_id, order_id), pconn) in pconns.items():
+        for pconn in pconns.values():
             pconn.send(("LNPROB", pars))
 
-        #Collect the answer from each process
-        lnps = np.empty((len(Starfish.data["orders"]),))
-        for i, pconn in enumerate(pconns.values()):
-            lnps[i] = pconn.recv()
-
-        result = np.sum(lnps) # + lnprior
+        result = gather_lnprob()
         print("proposed:", p, result)
         return result
 
     def query_lnprob():
-        for ((spectrum_id, order_id), pconn) in pconns.items():
-            pconn.send(("GET_LNPROB", None))
+        # Only ask the orders directly if no DECIDE has been sent yet
+        if lnprob_current is not None:
+            return lnprob_current
 
-        #Collect the answer from each process
-        lnps = np.empty((len(Starfish.data["orders"]),))
-        for i, pconn in enumerate(pconns.values()):
-            lnps[i] = pconn.recv()
+        for pconn in pconns.values():
+            pconn.send(("GET_LNPROB", None))
 
-        result = np.sum(lnps) # + lnprior
+        result = gather_lnprob()
         print("queried:", result)
         return result
 
+    def decide(yes):
+        global lnprob_current
+        for pconn in pconns.values():
+            pconn.send(("DECIDE", yes))
+
+        # Each order replies with its lnprob after the Phi update
+        lnprob_current = gather_lnprob()
+        print("current:", lnprob_current)
+
     def acceptfn():
         print("Calling acceptfn")
-        for ((spectrum_id, order_id), pconn) in pconns.items():
-            pconn.send(("DECIDE", True))
+        decide(True)
 
     def rejectfn():
         print("Calling rejectfn")
-        for ((spectrum_id, order_id), pconn) in pconns.items():
-            pconn.send(("DECIDE", False))
+        decide(False)
 
     from Starfish.samplers import StateSampler
 
@@ -204,7 +216,15 @@ if args.sample == "ThetaCheb" or args.sample == "ThetaPhi" or args.sample == "Th
         except FileNotFoundError:
             print("No optimal jump matrix found, using diagonal jump matrix.")
 
-    sampler = StateSampler(lnprob, p0, cov, query_lnprob=query_lnprob, acceptfn=acceptfn, rejectfn=rejectfn, debug=True, outdir=Starfish.routdir)
+    # Optionally propose the cheap parameters on their own, several times per full proposal
+    block = Starfish.config.get("Theta_block", None)
+    if block is not None:
+        names = ["temp", "logg", "Z", "vz", "vsini", "logOmega"]
+        block, nblock = [names.index(name) for name in block["params"]], block["N"]
+    else:
+        nblock = 0
+
+    sampler = StateSampler(lnprob, p0, cov, query_lnprob=query_lnprob, acceptfn=acceptfn, rejectfn=rejectfn, debug=True, outdir=Starfish.routdir, block=block, nblock=nblock)
 
     p, lnprob, state = sampler.run_mcmc(p0, N=args.samples, incremental_save=args.incremental_save)
     print("Final", p)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+# Measure the memory allocated by each steady-state Order.evaluate(), with tracemalloc.
+# Run from a directory with a config.yaml, after the grid, PCA and emulator are set up.
+# With the workspaces that Order preallocates, the peak should stay well below the
+# N * m * 8 bytes of a single (N, m) array.
+
+import sys
+sys.argv = sys.argv[:1]
+
+import tracemalloc
+import numpy as np
+
+import Starfish
+import Starfish.parallel as P
+from Starfish.model import ThetaParam, PhiParam
+
+theta = ThetaParam(grid=np.array(Starfish.config["Theta"]["grid"]), vz=Starfish.config["Theta"]["vz"],
+                   vsini=Starfish.config["Theta"]["vsini"], logOmega=Starfish.config["Theta"]["logOmega"],
+                   Av=Starfish.config["Theta"]["Av"])
+spectrum_id, order_key = 0, 0
+phi = PhiParam(spectrum_id, Starfish.data["orders"][order_key], True, np.zeros((Starfish.config["cheb_degree"] - 1,)), 1.0, -13.6, 20.)
+
+for Model in [P.OptimizeTheta, P.SampleThetaPhi]:
+    model = Model(debug=False)
+    model.initialize((spectrum_id, order_key))
+    if Model is P.SampleThetaPhi:
+        model.update_Phi(phi)
+    model.lnprob_Theta(theta)
+    model.evaluate()
+
+    tracemalloc.start()
+    for i in range(20):
+        model.evaluate()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    limit = model.ndata * model.pca.m * 8
+    print("{}: peak {} bytes per evaluate, N * m * 8 = {} bytes".format(Model.__name__, peak, limit))
+    assert peak < limit / 4, "{} allocates too much per evaluate".format(Model.__name__)
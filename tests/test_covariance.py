@@ -0,0 +1,126 @@
+import pytest
+
+import tracemalloc
+import numpy as np
+
+import Starfish.constants as C
+from Starfish.model import PhiParam
+from scipy.linalg import cho_factor, cho_solve
+
+from Starfish.covariance import get_dense_C, get_C, make_k_func, make_k_func_region, PixelDistances
+from Starfish.covariance import banded_to_dense, factor_banded, woodbury_lnlike, woodbury_solve
+
+class TestGetC:
+    def setup_class(self):
+        # A log-lambda spaced wavelength vector, ~2.5 km/s per pixel
+        self.wl = 5100. * np.exp(np.arange(400) * 2.5/C.c_kms)
+        self.regions = np.array([[-13.0, 5105., 7.], [-13.3, 5110., 5.]])
+        self.phi = PhiParam(spectrum_id=0, order=22, cheb=np.zeros((3,)),
+            sigAmp=1.0, logAmp=-13.6, l=20., regions=None)
+
+    def test_global(self):
+        max_r = 6.0 * self.phi.l
+        mat = get_dense_C(self.wl, k_func=make_k_func(self.phi), max_r=max_r)
+        assert np.allclose(get_C(self.wl, self.phi.logAmp, self.phi.l), mat, rtol=1e-10, atol=0)
+
+    def test_regions(self):
+        self.phi.regions = self.regions
+        max_r = 6.0 * self.phi.l
+        mat = get_dense_C(self.wl, k_func=make_k_func(self.phi), max_r=max_r)
+        assert np.allclose(get_C(self.wl, self.phi.logAmp, self.phi.l, self.regions, max_r=max_r), mat, rtol=1e-10, atol=0)
+
+        max_r = 4.0 * np.max(self.regions[:, 2])
+        mat = get_dense_C(self.wl, k_func=make_k_func_region(self.phi), max_r=max_r)
+        assert np.allclose(get_C(self.wl, regions=self.regions), mat, rtol=1e-10, atol=0)
+        self.phi.regions = None
+
+    def test_banded(self):
+        mat = get_C(self.wl, self.phi.logAmp, self.phi.l)
+        ab = get_C(self.wl, self.phi.logAmp, self.phi.l, banded=True)
+
+        # Only the diagonals within 6 l are stored
+        assert len(ab) == int(np.ceil(6.0 * self.phi.l / 2.5))
+
+        N = len(self.wl)
+        for d in range(len(ab)):
+            assert np.allclose(ab[d, :N - d], np.diag(mat, -d))
+        assert np.all(np.diag(mat, -len(ab)) == 0.0)
+
+    def test_pixel_distances(self):
+        # Store a larger radius than any single call needs, then reuse it
+        distances = PixelDistances(self.wl, 200.)
+        for l in [10., 20., 30.]:
+            for banded in [False, True]:
+                assert np.allclose(distances.get_C(self.phi.logAmp, l, banded=banded),
+                    get_C(self.wl, self.phi.logAmp, l, banded=banded), rtol=1e-10, atol=0)
+
+        assert np.allclose(distances.get_C(regions=self.regions), get_C(self.wl, regions=self.regions))
+
+        # Asking for more than the stored radius recomputes the separations
+        assert np.allclose(distances.get_C(self.phi.logAmp, 50.), get_C(self.wl, self.phi.logAmp, 50.))
+        assert distances.max_r >= 6.0 * 50.
+
+class TestWoodbury:
+    def setup_class(self):
+        np.random.seed(0)
+        self.wl = 5100. * np.exp(np.arange(300) * 2.5/C.c_kms)
+        N = len(self.wl)
+        self.sigma = 0.01 + 0.01 * np.random.rand(N)
+        self.X = np.asfortranarray(0.01 * np.random.randn(N, 4))
+        L = np.random.randn(4, 4)
+        self.C_X = L.dot(L.T) + np.eye(4)
+        self.R = self.sigma * np.random.randn(N)
+        self.B = np.random.randn(N, 3)
+
+        # White noise, and white noise plus a global covariance kernel
+        white = (self.sigma**2)[np.newaxis, :]
+        kernel = get_C(self.wl, -4.0, 20., banded=True)
+        kernel[0] += self.sigma**2
+        self.data_mats = [white, kernel]
+
+    def dense_lnlike(self, CC):
+        factor = cho_factor(CC)
+        logdet = 2 * np.sum(np.log(np.diag(factor[0])))
+        return -0.5 * (self.R.dot(cho_solve(factor, self.R)) + logdet)
+
+    def test_lnlike(self):
+        for data_mat in self.data_mats:
+            CC = banded_to_dense(data_mat) + self.X.dot(self.C_X).dot(self.X.T)
+            factor, logdet = factor_banded(data_mat)
+            lnp = woodbury_lnlike(factor, logdet, self.X, self.R, self.C_X)
+            assert np.allclose(lnp, self.dense_lnlike(CC), rtol=1e-12, atol=0)
+
+            # Solving in place into the workspaces gives the same answer
+            iDX, iDR = np.empty_like(self.X, order="F"), np.empty_like(self.R)
+            assert lnp == woodbury_lnlike(factor, logdet, self.X, self.R, self.C_X, iDX=iDX, iDR=iDR)
+
+    def test_memory(self):
+        # With the workspaces, nothing of the size of X is allocated per evaluation,
+        # for an order with as many pixels as a TRES order
+        N = 3000
+        wl = 5100. * np.exp(np.arange(N) * 2.5/C.c_kms)
+        sigma = 0.01 + 0.01 * np.random.rand(N)
+        X = np.asfortranarray(0.01 * np.random.randn(N, 4))
+        R = sigma * np.random.randn(N)
+        kernel = get_C(wl, -4.0, 20., banded=True)
+        kernel[0] += sigma**2
+        iDX, iDR = np.empty_like(X, order="F"), np.empty_like(R)
+
+        for data_mat in [(sigma**2)[np.newaxis, :], kernel]:
+            factor, logdet = factor_banded(data_mat)
+            woodbury_lnlike(factor, logdet, X, R, self.C_X, iDX=iDX, iDR=iDR)
+            tracemalloc.start()
+            woodbury_lnlike(factor, logdet, X, R, self.C_X, iDX=iDX, iDR=iDR)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert peak < X.nbytes / 4
+
+    def test_solve(self):
+        for data_mat in self.data_mats:
+            CC = banded_to_dense(data_mat) + self.X.dot(self.C_X).dot(self.X.T)
+            factor, logdet = factor_banded(data_mat)
+            assert np.allclose(woodbury_solve(factor, self.X, self.C_X, self.B), np.linalg.solve(CC, self.B))
+
+    def test_not_positive_definite(self):
+        with pytest.raises(np.linalg.LinAlgError):
+            factor_banded(-self.data_mats[0])
@@ -0,0 +1,185 @@
+import pytest
+
+import itertools
+import multiprocessing
+import numpy as np
+from multiprocessing import Pipe
+
+from Starfish.emulator import PCAGrid, Emulator, KronIdentity, Phi, get_w_hat
+from Starfish.covariance import Sigma, V12, V22, V12m, V22m
+from Starfish.transport import fork_context
+
+def make_pca(npix=300, m=3, seed=42):
+    '''
+    Create a small synthetic PCAGrid with orthonormal eigenspectra, spanning
+    a (temp, logg, Z) grid.
+    '''
+    np.random.seed(seed)
+    gparams = np.array(list(itertools.product([5800., 6000., 6200., 6400.],
+        [4.0, 4.5, 5.0], [-0.5, 0.0])))
+    M = len(gparams)
+
+    wl = np.linspace(5000., 5100., npix)
+    flux_mean = 1.0 + 0.1 * np.random.rand(npix)
+    flux_std = 0.1 + 0.01 * np.random.rand(npix)
+
+    # Orthonormal rows, just like the PCA components
+    eigenspectra = np.linalg.qr(np.random.randn(npix, m))[0].T
+
+    # Weights that vary smoothly across the grid
+    scaled = (gparams - gparams.mean(axis=0)) / gparams.std(axis=0)
+    w = np.array([np.sin(scaled.dot(np.random.randn(3))) for i in range(m)])
+    fluxes = w.T.dot(eigenspectra) + 1e-3 * np.random.randn(M, npix)
+    w_hat = get_w_hat(eigenspectra, fluxes, M)
+
+    return PCAGrid(wl, 2.0, flux_mean, flux_std, eigenspectra, w, w_hat, gparams)
+
+def make_eparams(m=3):
+    return np.hstack([np.array([2.0])] + [np.array([1.5, 300., 0.6, 0.5]) for i in range(m)])
+
+class TestKronIdentity:
+    def setup_class(self):
+        np.random.seed(0)
+        self.M = 7
+        self.eigenspectra = np.random.randn(3, 50)
+        self.PhiPhi = KronIdentity.from_eigenspectra(self.eigenspectra, self.M)
+        Phi_dense = Phi(self.eigenspectra, self.M)
+        self.PhiPhi_dense = Phi_dense.T.dot(Phi_dense)
+
+    def test_todense(self):
+        assert np.allclose(self.PhiPhi.todense(), self.PhiPhi_dense)
+
+    def test_dot_solve(self):
+        x = np.random.randn(3 * self.M)
+        X = np.random.randn(3 * self.M, 4)
+        assert np.allclose(self.PhiPhi.dot(x), self.PhiPhi_dense.dot(x))
+        assert np.allclose(self.PhiPhi.dot(X), self.PhiPhi_dense.dot(X))
+        assert np.allclose(self.PhiPhi.solve(x), np.linalg.solve(self.PhiPhi_dense, x))
+        assert np.allclose(self.PhiPhi.solve(X), np.linalg.solve(self.PhiPhi_dense, X))
+
+    def test_inv(self):
+        assert np.allclose((2. * self.PhiPhi.inv()).todense(), 2. * np.linalg.inv(self.PhiPhi_dense))
+        assert not self.PhiPhi.block_diagonal
+
+    def test_block_diagonal(self):
+        # The test is relative, so it does not depend on the scale of A
+        A = np.diag([2., 3., 5.])
+        A[0, 1] = A[1, 0] = 1e-6
+        for scale in [1e-10, 1., 1e10]:
+            assert not KronIdentity(scale * A, self.M).block_diagonal
+            assert KronIdentity(scale * np.diag([2., 3., 5.]), self.M).block_diagonal
+
+        assert KronIdentity(A, self.M).is_block_diagonal(rtol=1e-6)
+
+    def test_get_w_hat(self):
+        fluxes = np.random.randn(self.M, 50)
+        Phi_dense = Phi(self.eigenspectra, self.M)
+        w_hat = np.linalg.solve(self.PhiPhi_dense, Phi_dense.T.dot(fluxes.flatten()))
+        assert np.allclose(get_w_hat(self.eigenspectra, fluxes, self.M), w_hat)
+
+class TestEmulator:
+    def setup_class(self):
+        self.pca = make_pca()
+        self.eparams = make_eparams(self.pca.m)
+        self.emulator = Emulator(self.pca, self.eparams)
+        self.params = np.array([6100., 4.3, -0.2])
+
+        # Brute force versions of the emulator matrices
+        h2params = self.emulator.h2params
+        iPhiPhi = (1./self.emulator.lambda_xi) * np.eye(self.pca.m * self.pca.M)
+        self.V11 = iPhiPhi + Sigma(self.pca.gparams, h2params)
+
+    def test_matrix(self):
+        self.emulator.params = self.params
+        mu, sig = self.emulator.matrix
+
+        v12 = V12(self.params, self.pca.gparams, self.emulator.h2params, self.pca.m)
+        v22 = V22(self.params, self.emulator.h2params, self.pca.m)
+        mu_true = v12.T.dot(np.linalg.solve(self.V11, self.pca.w_hat))
+        sig_true = v22 - v12.T.dot(np.linalg.solve(self.V11, v12))
+
+        assert np.allclose(mu, mu_true)
+        assert np.allclose(sig, sig_true)
+
+    def test_draw_many_weights(self):
+        params = np.array([[6100., 4.3, -0.2], [5900., 4.7, -0.4]])
+        weights = self.emulator.draw_many_weights(params)
+        assert weights.shape == (2, self.pca.m)
+
+    def test_block_diagonal(self):
+        assert self.emulator.block_diagonal
+
+        dense = Emulator(self.pca, self.eparams, block_diagonal=False)
+        dense.params = self.params
+        self.emulator.params = self.params
+
+        assert np.allclose(dense.mu, self.emulator.mu)
+        assert np.allclose(dense.sig, self.emulator.sig)
+
+        params = np.array([[6100., 4.3, -0.2], [5900., 4.7, -0.4]])
+        for full_cov in [False, True]:
+            mu_dense, sig_dense = dense.predict(params, full_cov=full_cov)
+            mu, sig = self.emulator.predict(params, full_cov=full_cov)
+            assert np.allclose(mu_dense, mu)
+            assert np.allclose(sig_dense, sig)
+
+    def test_predict(self):
+        params = np.array([[6100., 4.3, -0.2], [5900., 4.7, -0.4], [6300., 4.0, 0.0]])
+        h2params = self.emulator.h2params
+        v12 = V12m(params, self.pca.gparams, h2params, self.pca.m)
+        v22 = V22m(params, h2params, self.pca.m)
+        mu_true = v12.T.dot(np.linalg.solve(self.V11, self.pca.w_hat))
+        sig_true = v22 - v12.T.dot(np.linalg.solve(self.V11, v12))
+
+        mu, sig = self.emulator.predict(params, full_cov=True)
+        assert mu.shape == (3, self.pca.m)
+        assert np.allclose(mu.flatten(), mu_true)
+        assert np.allclose(sig, sig_true)
+
+        mu, sig = self.emulator.predict(params)
+        assert sig.shape == (3, self.pca.m, self.pca.m)
+        for i in range(3):
+            block = slice(i * self.pca.m, (i + 1) * self.pca.m)
+            assert np.allclose(sig[i], sig_true[block, block])
+
+    def test_copy(self):
+        # Truncating a copy leaves the original alone, and keeps views of its arrays
+        emulator = self.emulator.copy()
+        emulator.pca.determine_chunk_log(np.array([5040., 5060.]), buffer=5.)
+        assert emulator.pca.npix < self.pca.npix
+        assert self.emulator.pca.npix == self.pca.npix
+        assert np.shares_memory(emulator.pca.eigenspectra, self.pca.eigenspectra)
+
+        emulator.params = self.params
+        self.emulator.params = self.params
+        assert np.allclose(emulator.mu, self.emulator.mu)
+        assert np.allclose(emulator.sig, self.emulator.sig)
+
+    def test_fork(self):
+        # Forked workers use the emulator of the parent, without pickling it. The
+        # target is a local function, which cannot be pickled, so the worker
+        # could not start with the spawn or forkserver methods either.
+        def worker(conn):
+            emulator = self.emulator.copy()
+            emulator.params = self.params
+            conn.send((id(self.emulator.pca.eigenspectra), emulator.mu))
+
+        pconn, cconn = Pipe()
+        p = fork_context().Process(target=worker, args=(cconn,))
+        p.start()
+        cconn.close()
+        eigenspectra_id, mu = pconn.recv()
+        p.join()
+        assert eigenspectra_id == id(self.pca.eigenspectra)
+        self.emulator.params = self.params
+        assert np.allclose(mu, self.emulator.mu)
+
+    def test_no_fork(self, monkeypatch):
+        monkeypatch.setattr(multiprocessing, "get_all_start_methods", lambda: ["spawn"])
+        with pytest.raises(RuntimeError):
+            fork_context()
+
+    def test_outside_grid(self):
+        from Starfish import constants as C
+        with pytest.raises(C.ModelError):
+            self.emulator.params = np.array([7000., 4.3, -0.2])
@@ -0,0 +1,64 @@
+import pytest
+
+import numpy as np
+
+from Starfish.samplers import StateSampler
+
+class StagedModel:
+    '''
+    A Gaussian posterior which caches an expensive stage like Order.update_Theta,
+    recomputing it only when one of the ``expensive`` parameters changes, and
+    reverting it when a proposal is rejected.
+    '''
+    def __init__(self, expensive):
+        self.expensive = expensive
+        self.stage, self.stage_last = None, None
+        self.lnp, self.lnp_last = None, None
+        self.nexpensive = 0
+
+    def lnprob(self, p):
+        self.stage_last, self.lnp_last = self.stage, self.lnp
+        stage = tuple(p[self.expensive])
+        if stage != self.stage:
+            self.nexpensive += 1
+            self.stage = stage
+        self.lnp = -0.5 * np.sum(p**2)
+        return self.lnp
+
+    def query_lnprob(self):
+        return self.lnp
+
+    def reject(self):
+        self.stage, self.lnp = self.stage_last, self.lnp_last
+
+class TestStateSampler:
+    def setup_class(self):
+        # (temp, logg, Z, vz, vsini, logOmega), with vz and logOmega cheap
+        self.p0 = np.zeros(6)
+        self.cov = 0.1 * np.eye(6)
+        self.block = [3, 5]
+        self.expensive = [0, 1, 2, 4]
+
+    def run(self, **kwargs):
+        model = StagedModel(self.expensive)
+        sampler = StateSampler(model.lnprob, self.p0, self.cov, query_lnprob=model.query_lnprob,
+                               rejectfn=model.reject, **kwargs)
+        sampler.random_state = np.random.RandomState(42).get_state()
+        sampler.run_mcmc(self.p0, N=1000)
+        return sampler, model
+
+    def test_unblocked(self):
+        sampler, model = self.run()
+        assert model.nexpensive > 500
+
+    def test_blocked(self):
+        sampler, model = self.run(block=self.block, nblock=9)
+
+        # The cached stage is only recomputed for the initial lnprob and every 10th proposal
+        assert model.nexpensive <= 1 + 1000 // 10
+
+        # Between the full proposals, only the cheap parameters move
+        steps = np.diff(sampler.chain, axis=0)
+        cheap = np.arange(1, 1000) % 10 != 0
+        assert np.all(steps[cheap][:, self.expensive] == 0.0)
+        assert np.any(steps[cheap][:, self.block] != 0.0)
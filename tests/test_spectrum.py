@@ -0,0 +1,130 @@
+import pytest
+
+import numpy as np
+
+import Starfish.constants as C
+from Starfish.spectrum import DataSpectrum, ChebyshevSpectrum, Resampler, BroadeningKernel
+from scipy.special import j1
+
+class TestResampler:
+    def setup_class(self):
+        self.wl_FFT = np.exp(np.linspace(np.log(5000.), np.log(5100.), 2048))
+        self.wl = np.linspace(5010., 5090., 700)
+        self.resampler = Resampler(self.wl_FFT, self.wl)
+
+    def func(self, wl):
+        return np.sin(wl/0.7) + np.cos(wl/0.31)
+
+    def test_resample(self):
+        fls = self.resampler.resample(self.func(self.wl_FFT))
+        assert np.allclose(fls, self.func(self.wl), atol=1e-6)
+
+        # Several spectra at once
+        fls = self.resampler.resample(np.vstack((self.func(self.wl_FFT), 2 * self.func(self.wl_FFT))))
+        assert fls.shape == (2, len(self.wl))
+        assert np.allclose(fls[1], 2 * self.func(self.wl), atol=1e-6)
+
+    def test_shift(self):
+        vz = 13.
+        resampler = Resampler(self.wl_FFT, self.wl)
+        resampler.update(vz)
+        fls = resampler.resample(self.func(self.wl_FFT))
+
+        # The spectrum is sampled on wl_FFT * doppler, so it is shifted redward
+        doppler = np.sqrt((C.c_kms + vz) / (C.c_kms - vz))
+        assert np.allclose(fls, self.func(self.wl / doppler), atol=1e-6)
+
+    def test_fourier_shift(self):
+        # For a band-limited spectrum, the phase ramp followed by the unshifted
+        # resampling matrix is the same as resampling from the shifted grid
+        vz = 7.
+        x = np.arange(len(self.wl_FFT))
+        fl = np.sin(2 * np.pi * 3 * x / len(x)) + 0.5 * np.cos(2 * np.pi * 5 * x / len(x))
+
+        resampler = Resampler(self.wl_FFT, self.wl)
+        shifted = np.fft.irfft(resampler.shift_FFT(np.fft.rfft(fl), vz), len(x))
+        fls_fourier = resampler.resample(shifted)
+
+        resampler.update(vz)
+        assert np.allclose(fls_fourier, resampler.resample(fl), rtol=0, atol=1e-12)
+
+    def test_update(self):
+        resampler = Resampler(self.wl_FFT, self.wl)
+        matrix = resampler.matrix
+
+        # A small shift only changes the weights
+        resampler.update(0.01)
+        assert resampler.matrix is matrix
+        assert np.allclose(resampler.resample(self.func(self.wl_FFT)), self.func(self.wl / np.sqrt((C.c_kms + 0.01) / (C.c_kms - 0.01))), atol=1e-6)
+
+        # A shift across a pixel rebuilds the matrix
+        resampler.update(20.)
+        assert resampler.matrix is not matrix
+        fresh = Resampler(self.wl_FFT, self.wl)
+        fresh.update(20.)
+        assert np.allclose(resampler.matrix.toarray(), fresh.matrix.toarray())
+
+class TestBroadeningKernel:
+    def setup_class(self):
+        self.ss = np.fft.rfftfreq(4096, d=1.5)
+        self.broadening = BroadeningKernel(self.ss, maxsize=3)
+
+    def exact(self, vsini):
+        ub = 2. * np.pi * vsini * self.ss[1:]
+        return j1(ub) / ub - 3 * np.cos(ub) / (2 * ub ** 2) + 3. * np.sin(ub) / (2 * ub ** 3)
+
+    def test_kernel(self):
+        for vsini in [5., 0.37, 12.3456, 48.9]:
+            kernel = self.broadening(vsini)
+            assert kernel[0] == 1.
+            assert np.max(np.abs(kernel[1:] - self.exact(vsini))) < self.broadening.tol
+
+        # On a grid point, the kernel is exact
+        vsini = 100 * self.broadening.step
+        assert np.allclose(self.broadening(vsini)[1:], self.exact(vsini), rtol=1e-12, atol=1e-14)
+
+    def test_cache(self):
+        index = int(4. / self.broadening.step)
+        kernel = self.broadening.grid_kernel(index)
+        assert self.broadening.grid_kernel(index) is kernel
+        assert not kernel.flags.writeable
+
+        # Least recently used kernels are dropped
+        for vsini in [6., 7.]:
+            self.broadening(vsini)
+        assert len(self.broadening.cache) == 3
+        assert self.broadening.grid_kernel(index) is not kernel
+
+    def test_random_walk(self):
+        # A sampler proposing vsini in steps of 0.01 km/s mostly reuses the cached kernels
+        broadening = BroadeningKernel(np.fft.rfftfreq(4096, d=2.8))
+        evaluate = broadening.evaluate
+        calls = []
+        def counted(vsini):
+            calls.append(vsini)
+            return evaluate(vsini)
+        broadening.evaluate = counted
+
+        np.random.seed(0)
+        walk = 5. + np.cumsum(0.01 * np.random.randn(1000))
+        for vsini in walk:
+            broadening(vsini)
+        assert len(calls) < 0.1 * len(walk)
+
+class TestChebyshevSpectrum:
+    def setup_class(self):
+        wls = np.linspace(5000., 5100., 200)
+        self.dataSpectrum = DataSpectrum(wls, np.ones_like(wls), np.ones_like(wls))
+        self.mask = np.ones((200,), dtype=bool)
+        self.mask[50:80] = False
+
+    def test_mask(self):
+        full = ChebyshevSpectrum(self.dataSpectrum, 0)
+        masked = ChebyshevSpectrum(self.dataSpectrum, 0, mask=self.mask)
+        assert masked.T.shape == (3, 170)
+
+        # The polynomials are still defined over the full order
+        p = np.array([0.01, -0.02, 0.005])
+        full.update(p)
+        masked.update(p)
+        assert np.allclose(masked.k, full.k[self.mask])
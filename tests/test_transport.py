@@ -0,0 +1,80 @@
+import pytest
+
+from multiprocessing import Pipe
+import numpy as np
+
+from Starfish.model import ThetaParam
+from Starfish.transport import SharedConnection, MPIConnection, MPIProcess
+
+class TestSharedConnection:
+    def setup_class(self):
+        pconn, cconn = Pipe()
+        buffer = SharedConnection.allocate(3)
+        self.master = SharedConnection(pconn, buffer)
+        self.worker = SharedConnection(cconn, buffer)
+
+    def test_lnprob(self):
+        p = ThetaParam(grid=np.array([6000., 4.29, -0.1]), vz=12.3, vsini=5.6, logOmega=-12.7, Av=0.1)
+        self.master.send(("LNPROB", p))
+        fname, q = self.worker.recv()
+        assert fname == "LNPROB"
+        assert np.all(q.grid == p.grid)
+        assert (q.vz, q.vsini, q.logOmega, q.Av) == (p.vz, p.vsini, p.logOmega, p.Av)
+
+        # The grid must not be a view of the shared buffer, which the next message overwrites
+        assert not np.shares_memory(q.grid, self.worker.buffer)
+
+    def test_commands(self):
+        for msg in [("DECIDE", True), ("DECIDE", False), ("GET_LNPROB", None)]:
+            self.master.send(msg)
+            assert self.worker.recv() == msg
+
+    def test_reply(self):
+        for lnp in [-1234.5, np.float64(72514.03929887892), -np.inf]:
+            self.worker.send(lnp)
+            assert self.master.recv() == lnp
+
+    def test_pickled(self):
+        # Control messages are still pickled
+        keys = [(0, 1), (1, 3)]
+        self.master.send(("INIT", keys))
+        assert self.worker.recv() == ("INIT", keys)
+        self.worker.send("DEAD")
+        assert self.master.recv() == "DEAD"
+
+class TestMPIConnection:
+    '''
+    Run with several processes, e.g. ``mpirun -n 4 python -m pytest tests/test_transport.py``.
+    Rank 0 plays the master, and every other rank echoes the messages back.
+    '''
+    def setup_class(self):
+        MPI = pytest.importorskip("mpi4py.MPI")
+        self.comm = MPI.COMM_WORLD
+        if self.comm.size < 2:
+            pytest.skip("needs at least 2 MPI processes")
+
+    def test_round_trip(self):
+        p = ThetaParam(grid=np.array([6000., 4.29, -0.1]), vz=12.3, vsini=5.6, logOmega=-12.7)
+        messages = [("INIT", [(0, 1)]), ("LNPROB", p), ("DECIDE", True), ("GET_LNPROB", None)]
+
+        if self.comm.rank == 0:
+            conns = [MPIConnection(self.comm, rank) for rank in range(1, self.comm.size)]
+            for fname, arg in messages:
+                for conn in conns:
+                    conn.send((fname, arg))
+                for conn in conns:
+                    echo = conn.recv()
+                    assert echo[0] == fname
+
+            for conn in conns:
+                conn.send(("DIE", None))
+            for conn in conns:
+                MPIProcess(conn).join()
+        else:
+            conn = MPIConnection(self.comm, 0)
+            while True:
+                msg = conn.recv()
+                if msg[0] == "DIE":
+                    break
+                conn.send(msg)
+            conn.send("DEAD")